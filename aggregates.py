@@ -0,0 +1,172 @@
+import numpy as np
+import pandas as pd
+
+from countries import iso3_codes
+from indexes import to_date_ns, date_span
+
+
+# Popularity sum/max/count per (entity, snapshot_date, country), sorted by
+# entity then date. The choropleth reduces one entity's date window of this
+# cube to a single value per country instead of plotting every chart row.
+class PopularityCube:
+    def __init__(self, keys, countries, dates, popularity):
+        keys = keys.astype('category')
+        countries = countries.astype('category')
+        self.categories = keys.cat.categories
+        self.countries = countries.cat.categories
+        # Resolved once per category so the map plots ISO-3 codes directly
+        self.iso3, self.country_names = iso3_codes(self.countries)
+
+        frame = pd.DataFrame({
+            'entity': keys.cat.codes.to_numpy(),
+            'date': to_date_ns(dates),
+            # Global chart rows have no country and keep code -1
+            'country': countries.cat.codes.to_numpy(),
+            'popularity': popularity.to_numpy(),
+        })
+        frame = frame[(frame['entity'] >= 0) & ~np.isnat(frame['date'].to_numpy().view('datetime64[ns]'))]
+        cube = (
+            frame.groupby(['entity', 'date', 'country'], sort=True)['popularity']
+            .agg(['sum', 'max', 'count'])
+            .reset_index()
+        )
+
+        self.entity = cube['entity'].to_numpy()
+        self.dates = cube['date'].to_numpy()
+        self.country = cube['country'].to_numpy()
+        self.sum = cube['sum'].to_numpy(dtype='int64')
+        self.max = cube['max'].to_numpy(dtype='int16')
+        self.count = cube['count'].to_numpy(dtype='int32')
+
+        counts = np.bincount(self.entity, minlength=len(self.categories))
+        self.offsets = np.concatenate([[0], np.cumsum(counts)])
+
+    def _window(self, entity, start_date=None, end_date=None):
+        code = self.categories.get_indexer([entity])[0]
+        if code < 0:
+            return slice(0, 0)
+        lo, hi = date_span(self.dates, self.offsets[code], self.offsets[code + 1], start_date, end_date)
+        return slice(lo, hi)
+
+    def _windows(self, entities, start_date=None, end_date=None):
+        # Cube positions inside every entity's date window, with the index of
+        # the entity each position belongs to
+        spans = [self._window(entity, start_date, end_date) for entity in entities]
+        positions = np.concatenate([np.arange(span.start, span.stop) for span in spans] + [np.empty(0, dtype='int64')])
+        labels = np.repeat(np.arange(len(spans)), [span.stop - span.start for span in spans])
+        return positions, labels
+
+    def by_country_many(self, entities, start_date=None, end_date=None):
+        # Per-country stats of several entities in one pass: a single bincount
+        # over (entity, country) keys, costing the selected cube rows only
+        positions, labels = self._windows(entities, start_date, end_date)
+        country = self.country[positions]
+        keep = country >= 0
+        positions = positions[keep]
+
+        n = len(self.countries)
+        key = labels[keep] * n + country[keep]
+        size = len(entities) * n
+        total = np.bincount(key, weights=self.sum[positions], minlength=size)
+        count = np.bincount(key, weights=self.count[positions], minlength=size)
+        peak = np.zeros(size, dtype='int16')
+        np.maximum.at(peak, key, self.max[positions])
+
+        charted = np.flatnonzero(count > 0)
+        entity, country = np.divmod(charted, n)
+        return pd.DataFrame({
+            'entity': np.asarray(entities, dtype=object)[entity],
+            'iso3': self.iso3[country],
+            'country': self.country_names[country],
+            'popularity': total[charted] / count[charted],
+            'max_popularity': peak[charted],
+            'entries': count[charted].astype('int32'),
+        })
+
+    def by_country(self, entity, start_date=None, end_date=None):
+        return self.by_country_many([entity], start_date, end_date).drop(columns='entity')
+
+    def global_chart_many(self, entities, start_date=None, end_date=None):
+        # The global chart's rows (no country) as their own series, one row
+        # per entity that charted globally in the window
+        positions, labels = self._windows(entities, start_date, end_date)
+        rows = self.country[positions] < 0
+        positions, labels = positions[rows], labels[rows]
+
+        size = len(entities)
+        total = np.bincount(labels, weights=self.sum[positions], minlength=size)
+        count = np.bincount(labels, weights=self.count[positions], minlength=size)
+        peak = np.zeros(size, dtype='int16')
+        np.maximum.at(peak, labels, self.max[positions])
+
+        charted = np.flatnonzero(count > 0)
+        return pd.DataFrame({
+            'entity': np.asarray(entities, dtype=object)[charted],
+            'popularity': total[charted] / count[charted],
+            'max_popularity': peak[charted],
+            'entries': count[charted].astype('int32'),
+        })
+
+
+# One row per unique track (integer track codes) holding the mean of each
+# audio feature, plus a date-sorted (date, country, track) row list so that
+# top-K queries can be restricted to a country set and/or date window.
+class TrackFeatures:
+    def __init__(self, table, features):
+        labels = table.tracks['track_id'].astype('category')
+        self.categories = labels.cat.categories
+        label = labels.cat.codes.to_numpy()
+        keep = label >= 0
+
+        # Averaged over the track table, each description weighted by its
+        # chart rows, so the result equals the old per-row mean
+        rows = np.bincount(table.track, minlength=len(label)).astype('float64')
+        self.features = {}
+        for name in features:
+            values = table.tracks[name].to_numpy(dtype='float64')
+            valid = keep & ~np.isnan(values)
+            total = np.bincount(label[valid], weights=rows[valid] * values[valid], minlength=len(self.categories))
+            count = np.bincount(label[valid], weights=rows[valid], minlength=len(self.categories))
+            with np.errstate(invalid='ignore', divide='ignore'):
+                self.features[name] = np.where(count > 0, total / count, np.nan)
+        codes = label[table.track]
+
+        countries = table['country'].astype('category')
+        self.countries = countries.cat.categories
+        date_ns = to_date_ns(table['snapshot_date'])
+        order = np.argsort(date_ns, kind='stable')
+        self.dates = date_ns[order]
+        self.country = countries.cat.codes.to_numpy()[order]
+        self.track = codes[order]
+
+    def eligible(self, countries=None, start_date=None, end_date=None):
+        # Tracks that charted in the given countries within the date window
+        if countries is None and start_date is None and end_date is None:
+            return None
+        lo, hi = date_span(self.dates, 0, len(self.dates), start_date, end_date)
+        track = self.track[lo:hi]
+        if countries is not None:
+            wanted = self.countries.get_indexer(list(countries))
+            track = track[np.isin(self.country[lo:hi], wanted[wanted >= 0])]
+        mask = np.zeros(len(self.categories), dtype=bool)
+        mask[track[track >= 0]] = True
+        return mask
+
+    def top_k(self, attribute, k=10, countries=None, start_date=None, end_date=None):
+        values = self.features[attribute].copy()
+        mask = self.eligible(countries, start_date, end_date)
+        if mask is not None:
+            values[~mask] = np.nan
+        values[np.isnan(values)] = -np.inf
+
+        k = min(k, int(np.isfinite(values).sum()))
+        if k == 0:
+            codes = np.array([], dtype='int64')
+        else:
+            # Partial selection of the k largest, then sort only those k
+            codes = np.argpartition(-values, k - 1)[:k]
+            codes = codes[np.argsort(-values[codes], kind='stable')]
+        return pd.DataFrame({
+            'track_id': self.categories[codes],
+            attribute: values[codes],
+        })
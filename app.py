@@ -1,17 +1,12 @@
 import dash
 from dash import dcc, html, Input, Output
-import pandas as pd
 import plotly.express as px
 import dash_bootstrap_components as dbc
 
-# Load dataset
-df = pd.read_csv("universal_top_spotify_songs.csv")
+from data_loader import load_dataset
 
-# Clean & prep columns
-df.columns = df.columns.str.strip().str.lower().str.replace(" ", "_")
-df['snapshot_date'] = pd.to_datetime(df['snapshot_date'], errors='coerce')
-df['year'] = df['snapshot_date'].dt.year
-df['month'] = df['snapshot_date'].dt.month
+# Load dataset (cleaned, served from the columnar cache after the first run)
+df = load_dataset()
 
 # Audio features to analyze
 audio_features = [
@@ -20,8 +15,6 @@ audio_features = [
 ]
 
 # Get top unique artists/songs
-df['artists'] = df['artists'].astype(str)
-df['track_id'] = df['artists'] + " | " + df['name']
 top_artists = df['artists'].dropna().unique()
 top_tracks = df['track_id'].dropna().unique()
 
@@ -159,7 +152,7 @@ def update_visuals(view, entity, year_range):
     Input('bar-attribute', 'value')
 )
 def update_bar_chart(attribute):
-    bar_data = df.groupby('track_id')[attribute].mean().sort_values(ascending=False).head(10).reset_index()
+    bar_data = df.groupby('track_id', observed=True)[attribute].mean().sort_values(ascending=False).head(10).reset_index()
     fig = px.bar(bar_data, x='track_id', y=attribute, title=f"{attribute.capitalize()} by Song")
     fig.update_layout(paper_bgcolor='#191414', plot_bgcolor='#191414', font_color='#FFFFFF')
     return fig
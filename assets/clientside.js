@@ -0,0 +1,36 @@
+// Clientside Dash callbacks: these run in the browser without a server round-trip
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    spotify: {
+        // Cut every selected entity's daily popularity series down to the
+        // picked date window, one trace each from the figure's template
+        // trace; dates are 'YYYY-MM-DD' so they compare as text
+        dailyPopularity: function(data, startDate, endDate) {
+            if (!data) {
+                return window.dash_clientside.no_update;
+            }
+            const start = startDate ? startDate.slice(0, 10) : null;
+            const end = endDate ? endDate.slice(0, 10) : null;
+            const template = data.figure.data[0];
+
+            const traces = data.series.map(function(series) {
+                const x = [];
+                const y = [];
+                for (let i = 0; i < series.dates.length; i++) {
+                    const day = series.dates[i];
+                    if ((start === null || day >= start) && (end === null || day <= end)) {
+                        x.push(day);
+                        y.push(series.popularity[i]);
+                    }
+                }
+                return Object.assign({}, template, {
+                    name: series.entity,
+                    showlegend: data.series.length > 1,
+                    x: x,
+                    y: y
+                });
+            });
+            return Object.assign({}, data.figure, {data: traces});
+        }
+    }
+});
@@ -0,0 +1,448 @@
+import argparse
+import gzip
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+# Benchmark sizes, selectable with --sizes
+SIZES = {
+    '10k': 10_000,
+    '1m': 1_000_000,
+    '10m': 10_000_000,
+}
+
+RESULTS_PATH = "benchmark_results.json"
+BASELINE_PATH = "benchmark_baseline.json"
+
+# A metric regresses when it grows past baseline * (1 + tolerance)
+TOLERANCE = 0.25
+
+# The real dump charts ~50 songs a day in ~72 countries plus the global chart
+COUNTRIES = [
+    '', 'AE', 'AR', 'AT', 'AU', 'BE', 'BG', 'BO', 'BR', 'BY', 'CA', 'CH', 'CL', 'CO', 'CR', 'CZ', 'DE',
+    'DK', 'DO', 'EC', 'EE', 'EG', 'ES', 'FI', 'FR', 'GB', 'GR', 'GT', 'HK', 'HN', 'HU', 'ID', 'IE', 'IL',
+    'IN', 'IS', 'IT', 'JP', 'KR', 'KZ', 'LT', 'LU', 'LV', 'MA', 'MX', 'MY', 'NG', 'NI', 'NL', 'NO', 'NZ',
+    'PA', 'PE', 'PH', 'PK', 'PL', 'PT', 'PY', 'RO', 'SA', 'SE', 'SG', 'SK', 'SV', 'TH', 'TR', 'TW', 'UA',
+    'US', 'UY', 'VE', 'VN', 'ZA',
+]
+RANKS = 50
+
+# Representative callback inputs
+ATTRIBUTES = ['energy', 'tempo', 'duration_ms']
+SCATTER_PAIRS = [('danceability', 'energy'), ('tempo', 'loudness')]
+SEARCHES = ['a', 'the', 'zz']
+
+
+def generate(rows, path, seed=0):
+    # Synthetic chart dump with the real 23-column layout and date format:
+    # one block of RANKS rows per country per day, tracks drawn from a pool
+    # whose audio profile is fixed per track like in the real file
+    rng = np.random.default_rng(seed)
+    n_tracks = max(100, rows // 150)
+    n_artists = max(50, n_tracks // 3)
+
+    track_artist = rng.integers(0, n_artists, n_tracks)
+    collab = rng.random(n_tracks) < 0.2
+    artist_names = np.array([f"Artist {i}" for i in range(n_artists)], dtype=object)
+    credits = artist_names[track_artist].copy()
+    credits[collab] = credits[collab] + ", " + artist_names[rng.integers(0, n_artists, collab.sum())]
+    profile = {
+        'is_explicit': np.where(rng.random(n_tracks) < 0.3, 'TRUE', 'FALSE'),
+        'duration_ms': rng.integers(90_000, 400_000, n_tracks),
+        'album_name': np.array([f"Album {i}" for i in rng.integers(0, n_tracks, n_tracks)], dtype=object),
+        'album_release_date': np.asarray(
+            (pd.to_datetime('2024-01-01') - pd.to_timedelta(rng.integers(0, 3000, n_tracks), 'D')).strftime('%d %m %Y'),
+            dtype=object),
+        'danceability': rng.random(n_tracks).round(3),
+        'energy': rng.random(n_tracks).round(3),
+        'key': rng.integers(0, 12, n_tracks),
+        'loudness': (-rng.random(n_tracks) * 20).round(3),
+        'mode': rng.integers(0, 2, n_tracks),
+        'speechiness': (rng.random(n_tracks) * 0.5).round(4),
+        'acousticness': rng.random(n_tracks).round(3),
+        'instrumentalness': (rng.random(n_tracks) ** 4).round(6),
+        'liveness': rng.random(n_tracks).round(3),
+        'valence': rng.random(n_tracks).round(3),
+        'tempo': (60 + rng.random(n_tracks) * 140).round(3),
+        'time_signature': rng.choice([3, 4, 5], n_tracks, p=[0.1, 0.85, 0.05]),
+    }
+
+    block = np.arange(rows) // RANKS
+    country = np.array(COUNTRIES, dtype=object)[block % len(COUNTRIES)]
+    day = block // len(COUNTRIES)
+    # Format each distinct day once; strftime per row dominates at 10M rows
+    dates = np.asarray(pd.date_range('2023-10-18', periods=day[-1] + 1).strftime('%d %m %Y'), dtype=object)
+    # Popular tracks chart far more often than the long tail
+    track = np.minimum((rng.pareto(1.2, rows) * n_tracks / 50).astype(np.int64), n_tracks - 1)
+
+    df = pd.DataFrame({
+        'artists': credits[track],
+        'daily_rank': np.arange(rows) % RANKS + 1,
+        'daily_movement': rng.integers(-10, 11, rows),
+        'weekly_movement': rng.integers(-49, 50, rows),
+        'country': country,
+        'snapshot_date': dates[day],
+        'popularity': rng.integers(0, 101, rows),
+    })
+    for col in ['is_explicit', 'duration_ms', 'album_name', 'album_release_date']:
+        df[col] = profile[col][track]
+    for col in ['danceability', 'energy', 'key', 'loudness', 'mode', 'speechiness', 'acousticness',
+                'instrumentalness', 'liveness', 'valence', 'tempo', 'time_signature']:
+        df[col] = profile[col][track]
+    df.to_csv(path, index=False)
+
+
+def check_cache_sync(workdir, days=3):
+    # The Parquet cache must track the CSV: appends are ingested, any other
+    # rewrite (edited rows, a newest-first re-download that completes a
+    # partial day) rebuilds, and same-named dumps in other folders stay apart
+    from data_loader import load_tables
+
+    def rewrite(path, df):
+        df.to_csv(path, index=False)
+        os.utime(path, ns=(time.time_ns(), time.time_ns() + 10**9))
+
+    def expect(label, got, wanted):
+        if got != wanted:
+            raise RuntimeError(f"cache check '{label}': got {got}, expected {wanted}")
+
+    cache_dir = os.path.join(workdir, "cache")
+    csv_path = os.path.join(workdir, "a", "universal_top_spotify_songs.csv")
+    other_path = os.path.join(workdir, "b", "universal_top_spotify_songs.csv")
+    os.makedirs(os.path.dirname(csv_path))
+    os.makedirs(os.path.dirname(other_path))
+    rows = days * len(COUNTRIES) * RANKS
+    generate(rows, csv_path)
+    full = pd.read_csv(csv_path, keep_default_na=False)
+
+    # Half the countries of the last day, then the complete dump newest-first
+    rewrite(csv_path, full.iloc[:rows - len(COUNTRIES) * RANKS // 2])
+    load_tables(csv_path, cache_dir)
+    rewrite(csv_path, full.iloc[::-1])
+    expect("completed day", len(load_tables(csv_path, cache_dir)), rows)
+
+    # Appended rows are parsed on their own
+    rewrite(csv_path, full.iloc[:rows // 2])
+    load_tables(csv_path, cache_dir)
+    with open(csv_path, 'a') as f:
+        full.iloc[rows // 2:].to_csv(f, index=False, header=False)
+    expect("append", int(load_tables(csv_path, cache_dir)['popularity'].sum()), int(full['popularity'].sum()))
+
+    # Rows edited in place
+    rewrite(csv_path, full.assign(popularity=1))
+    expect("edited rows", int(load_tables(csv_path, cache_dir)['popularity'].sum()), rows)
+
+    # A different dump under the same file name
+    generate(rows // 2, other_path, seed=1)
+    expect("other folder", len(load_tables(other_path, cache_dir)), rows // 2)
+    expect("first folder", len(load_tables(csv_path, cache_dir)), rows)
+
+
+def measure(func, repeat=1, setup=None):
+    # Median wall time over `repeat` untraced runs, then one more run under
+    # tracemalloc for the peak (tracing slows allocations too much to time)
+    timings = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - start)
+
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, {'seconds': statistics.median(timings), 'peak_mb': peak / 2**20}
+
+
+def dash_request(client, outputs, inputs, state=(), changed=None, headers=None):
+    # Same JSON body the Dash renderer posts for a callback
+    outs = [{'id': i, 'property': p} for i, p in outputs]
+    if len(outs) == 1:
+        output = f"{outputs[0][0]}.{outputs[0][1]}"
+    else:
+        output = ".." + "...".join(f"{i}.{p}" for i, p in outputs) + ".."
+    body = {
+        'output': output,
+        'outputs': outs if len(outs) > 1 else outs[0],
+        'inputs': [{'id': i, 'property': p, 'value': v} for i, p, v in inputs],
+        'state': [{'id': i, 'property': p, 'value': v} for i, p, v in state],
+        'changedPropIds': [changed or f"{inputs[0][0]}.{inputs[0][1]}"],
+    }
+    response = client.post('/_dash-update-component', json=body, headers=headers)
+    if response.status_code != 200:
+        raise RuntimeError(f"{output} returned HTTP {response.status_code}")
+    return response.get_data()
+
+
+def callback_cases(data):
+    df = data.table
+    first, last = df['snapshot_date'].min(), df['snapshot_date'].max()
+    month_start = last - pd.Timedelta(days=30)
+    full = (str(first.date()), str(last.date()))
+    month = (str(month_start.date()), str(last.date()))
+    top_track = df['track_id'].value_counts().index[0]
+    # The artist view matches individual names, not raw credit strings
+    top_artists = data.artist_bridge.keys().value_counts().index[:5].tolist()
+    top_artist = top_artists[0]
+
+    cases = {}
+    for view in ['song', 'artist']:
+        cases[f"update_dropdown[{view}]"] = (
+            [('entity-dropdown', 'options'), ('entity-dropdown', 'value')],
+            [('view-radio', 'value', view), ('entity-dropdown', 'search_value', None),
+             ('entity-dropdown', 'value', None)],
+            (),
+            None,
+        )
+    for query in SEARCHES:
+        cases[f"update_dropdown[search={query}]"] = (
+            [('entity-dropdown', 'options'), ('entity-dropdown', 'value')],
+            [('view-radio', 'value', 'song'), ('entity-dropdown', 'search_value', query),
+             ('entity-dropdown', 'value', [top_track])],
+            (),
+            'entity-dropdown.search_value',
+        )
+    selections = [('song', [top_track]), ('artist', [top_artist]), ('compare', top_artists)]
+    for label, entities in selections:
+        view = 'song' if label == 'song' else 'artist'
+        for window, (start, end) in [('full', full), ('30d', month)]:
+            cases[f"update_map[{label},{window}]"] = (
+                [('choropleth-map', 'figure')],
+                [('view-radio', 'value', view), ('entity-dropdown', 'value', entities),
+                 ('start-date', 'date', start), ('end-date', 'date', end)],
+                [],
+                None,
+            )
+        # The line chart's date window is applied in the browser
+        cases[f"update_daily_series[{label}]"] = (
+            [('daily-series', 'data')],
+            [('view-radio', 'value', view), ('entity-dropdown', 'value', entities)],
+            [],
+            None,
+        )
+        cases[f"update_trajectory[{label}]"] = (
+            [('trajectory-chart', 'figure')],
+            [('view-radio', 'value', view), ('entity-dropdown', 'value', entities),
+             ('trajectory-country', 'value', 'global'),
+             ('start-date', 'date', full[0]), ('end-date', 'date', full[1])],
+            [],
+            None,
+        )
+    for attribute in ATTRIBUTES:
+        cases[f"update_bar_chart[{attribute}]"] = (
+            [('bar-chart', 'figure')],
+            [('bar-attribute', 'value', attribute)],
+            [],
+            None,
+        )
+    for x_attr, y_attr in SCATTER_PAIRS:
+        cases[f"update_scatter[{x_attr},{y_attr}]"] = (
+            [('scatter-plot', 'figure')],
+            [('x-attribute', 'value', x_attr), ('y-attribute', 'value', y_attr)],
+            [],
+            None,
+        )
+    return cases
+
+
+def parse_worker_counts(limit):
+    # 1, 2, 4, ... up to and including limit
+    counts = [1]
+    while counts[-1] * 2 < limit:
+        counts.append(counts[-1] * 2)
+    return counts + [limit] if limit > 1 else counts
+
+
+def run_size(rows, workdir, repeat):
+    # Runs in its own process so peak RSS belongs to this size only
+    import resource
+
+    csv_path = os.path.join(workdir, "universal_top_spotify_songs.csv")
+    cache_dir = os.path.join(workdir, "cache")
+    os.environ.update({
+        'SPOTIFY_DATA_PATH': csv_path,
+        'SPOTIFY_CACHE_DIR': cache_dir,
+        'SPOTIFY_REFRESH_SECONDS': '0',
+        # Time the figure work itself, not the background job round-trips
+        'SPOTIFY_BACKGROUND': '0',
+    })
+
+    from data_loader import PARSE_WORKERS, load_tables, read_csv_parallel, read_source, read_streaming, sync_dataset
+    from queries import build_database
+    from store import AUDIO_FEATURES, ChartData, ChartStore
+
+    start = time.perf_counter()
+    generate(rows, csv_path)
+    startup = {
+        'generate_csv': {'seconds': time.perf_counter() - start, 'csv_bytes': os.path.getsize(csv_path)},
+    }
+    shared_dir = os.path.join(cache_dir, "shared")
+    table, startup['csv_load'] = measure(lambda: load_tables(csv_path, use_cache=False))
+    _, startup['cache_build'] = measure(lambda: sync_dataset(csv_path, cache_dir),
+                                        setup=lambda: shutil.rmtree(cache_dir, ignore_errors=True))
+    _, startup['cache_load'] = measure(lambda: load_tables(csv_path, cache_dir), repeat)
+    # Cold parse time from 1 to PARSE_WORKERS processes (files under
+    # PARALLEL_MIN_BYTES always parse serially)
+    startup['csv_parse'] = {}
+    for workers in parse_worker_counts(PARSE_WORKERS):
+        _, startup['csv_parse'][f"workers_{workers}"] = measure(lambda: read_csv_parallel(csv_path, workers), repeat)
+    # Streaming straight out of a gzip dump; peak_mb should stay well under csv_bytes
+    gz_path = f"{csv_path}.gz"
+    with open(csv_path, 'rb') as src, gzip.open(gz_path, 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+    _, startup['gzip_parse'] = measure(lambda: read_source(gz_path), repeat)
+    startup['gzip_parse']['gz_bytes'] = os.path.getsize(gz_path)
+    # Chunked load under a ceiling of a quarter of the CSV size
+    stream_limit_mb = max(16, os.path.getsize(csv_path) // 4 // 2**20)
+    _, startup['streaming_load'] = measure(lambda: read_streaming(csv_path, stream_limit_mb), repeat)
+    startup['streaming_load']['limit_mb'] = stream_limit_mb
+    _, startup['chart_data'] = measure(lambda: ChartData(table))
+    _, startup['store_publish'] = measure(lambda: ChartStore(csv_path, cache_dir),
+                                          setup=lambda: shutil.rmtree(shared_dir, ignore_errors=True))
+    _, startup['store_attach'] = measure(lambda: ChartStore(csv_path, cache_dir), repeat)
+    startup['chart_data']['frame_mb'] = table.memory_usage() / 2**20
+    # SQL query backend database (SPOTIFY_QUERY_BACKEND=sqlite)
+    db_path = os.path.join(workdir, "charts.sqlite")
+    _, startup['query_db_build'] = measure(lambda: build_database(table, db_path, 'sqlite', AUDIO_FEATURES))
+    startup['query_db_build']['db_bytes'] = os.path.getsize(db_path)
+    # What the same rows cost as one wide frame
+    startup['chart_data']['wide_frame_mb'] = table.frame().memory_usage(deep=True).sum() / 2**20
+    del table
+
+    import unwrapped
+
+    client = unwrapped.app.server.test_client()
+    callbacks = {}
+    for name, case in callback_cases(unwrapped.store.data).items():
+        # Cold call with an empty figure cache, then warm repeats
+        payload, cold = measure(lambda: dash_request(client, *case), setup=unwrapped.figure_cache.bump_version)
+        _, warm = measure(lambda: dash_request(client, *case), repeat)
+        callbacks[name] = {
+            'seconds': cold['seconds'],
+            'warm_seconds': warm['seconds'],
+            'peak_mb': cold['peak_mb'],
+            'payload_bytes': len(payload),
+            # What a browser actually downloads once gzip is negotiated
+            'wire_bytes': len(dash_request(client, *case, headers={'Accept-Encoding': 'gzip'})),
+        }
+
+    return {
+        'rows': rows,
+        'startup': startup,
+        'callbacks': callbacks,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def flatten(results):
+    # {"1m.callbacks.update_scatter[...].seconds": 0.12, ...}
+    flat = {}
+
+    def walk(prefix, node):
+        for key, value in node.items():
+            name = f"{prefix}.{key}" if prefix else key
+            if isinstance(value, dict):
+                walk(name, value)
+            elif isinstance(value, (int, float)):
+                flat[name] = value
+
+    walk('', results)
+    return flat
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    regressions = []
+    current = flatten(results)
+    for name, before in flatten(baseline).items():
+        metric = name.rsplit('.', 1)[-1]
+        if metric not in ('seconds', 'warm_seconds', 'peak_mb', 'payload_bytes', 'wire_bytes') or name not in current:
+            continue
+        after = current[name]
+        if before > 0 and after > before * (1 + tolerance):
+            regressions.append({'metric': name, 'baseline': before, 'current': after,
+                                'change': after / before - 1})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the loader and every Dash callback on synthetic data")
+    parser.add_argument('--sizes', default='10k,1m', help=f"comma-separated subset of {', '.join(SIZES)}")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', default=RESULTS_PATH)
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true', help="store these results as the new baseline")
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    parser.add_argument('--run-size', help=argparse.SUPPRESS)
+    parser.add_argument('--workdir', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_size:
+        print(json.dumps(run_size(SIZES[args.run_size], args.workdir, args.repeat)))
+        return 0
+
+    with tempfile.TemporaryDirectory() as workdir:
+        check_cache_sync(workdir)
+
+    results = {}
+    for label in args.sizes.split(','):
+        with tempfile.TemporaryDirectory() as workdir:
+            proc = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), '--run-size', label,
+                 '--workdir', workdir, '--repeat', str(args.repeat)],
+                capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+            )
+        if proc.returncode != 0:
+            print(proc.stderr, file=sys.stderr)
+            raise RuntimeError(f"benchmark for {label} failed")
+        results[label] = json.loads(proc.stdout.strip().splitlines()[-1])
+        print(f"{label}: peak RSS {results[label]['peak_rss_mb']:.0f} MB, "
+              f"cold CSV load {results[label]['startup']['csv_load']['seconds']:.2f} s")
+        print(f"{label}: CSV parse " + ", ".join(
+            f"{name.split('_')[1]} workers {timing['seconds']:.2f} s"
+            for name, timing in results[label]['startup']['csv_parse'].items()))
+
+    report = {
+        'meta': {
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+        },
+        'results': results,
+    }
+
+    regressions = []
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f)['results'], args.tolerance)
+    report['regressions'] = regressions
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    for regression in regressions:
+        print(f"REGRESSION {regression['metric']}: {regression['baseline']:.4g} -> "
+              f"{regression['current']:.4g} (+{regression['change']:.0%})")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
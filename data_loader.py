@@ -0,0 +1,545 @@
+import csv
+import gzip
+import hashlib
+import io
+import json
+import os
+import sys
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+try:
+    import zstandard
+except ImportError:  # .zst dumps then can't be read
+    zstandard = None
+
+try:
+    import resource
+except ImportError:  # Windows; peak RSS then goes unreported
+    resource = None
+
+from tables import ChartTable, TableBuilder, concat_column, concat_frames, concat_tables, split_frame
+from trajectory import TRAJECTORY_COLUMNS, add_trajectory
+
+# Raw daily chart dump and the folder holding its cleaned columnar copy
+DATA_PATH = os.environ.get("SPOTIFY_DATA_PATH", "universal_top_spotify_songs.csv")
+CACHE_DIR = os.environ.get("SPOTIFY_CACHE_DIR", ".spotify_cache")
+
+# Bump whenever SCHEMA, clean_frame(), the trajectory columns or the
+# fact/track split change so old caches are not reused
+CACHE_VERSION = 5
+
+# Processes parsing a cold CSV in parallel byte ranges (1 parses serially)
+PARSE_WORKERS = int(os.environ.get(
+    "SPOTIFY_PARSE_WORKERS",
+    len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1,
+))
+
+# Smaller files parse faster than a process pool starts
+PARALLEL_MIN_BYTES = 32 << 20
+
+# Leading bytes of the compressed dumps the loader reads without extracting
+MAGIC_BYTES = {
+    b'\x1f\x8b': 'gzip',
+    b'PK\x03\x04': 'zip',
+    b'\x28\xb5\x2f\xfd': 'zstd',
+}
+
+# Rows parsed per chunk while streaming a compressed dump, which bounds the
+# decompressed text held at once
+STREAM_CHUNK_ROWS = 200_000
+
+# Memory ceiling (MB) for low-RAM hosts. When set, cold loads stream the dump
+# in chunks sized to it, each cleaned and split into the compact tables
+# before the next is read; unset parses the whole dump in one go
+MEMORY_LIMIT_MB = int(os.environ.get("SPOTIFY_MEMORY_LIMIT_MB", 0)) or None
+
+# Share of the ceiling one chunk's CSV text may take: parsing and cleaning a
+# chunk need several times its text, and the tables built so far stay resident
+CHUNK_SHARE = 1 / 16
+
+# Working memory per chart row while computing its trajectory columns
+TRAJECTORY_ROW_BYTES = 100
+
+# Appended snapshot days are stored as extra Parquet parts (a fact file and a
+# track file each); past this many the cache is compacted back into one
+MAX_PARTS = 32
+
+# Declared dtypes for the 23 columns of the chart dump. Repeated strings are
+# categoricals, ranks and small codes fit in int8, audio features in float32.
+# Dates are read as categoricals too and parsed once per distinct value.
+SCHEMA = {
+    'artists': 'category',
+    'daily_rank': 'int8',
+    'daily_movement': 'int8',
+    'weekly_movement': 'int8',
+    'country': 'category',
+    'snapshot_date': 'category',
+    'popularity': 'int8',
+    'is_explicit': 'bool',
+    'duration_ms': 'int32',
+    'album_name': 'category',
+    'album_release_date': 'category',
+    'danceability': 'float32',
+    'energy': 'float32',
+    'key': 'int8',
+    'loudness': 'float32',
+    'mode': 'int8',
+    'speechiness': 'float32',
+    'acousticness': 'float32',
+    'instrumentalness': 'float32',
+    'liveness': 'float32',
+    'valence': 'float32',
+    'tempo': 'float32',
+    'time_signature': 'int8',
+}
+
+# Columns present in the full Kaggle export but not in every re-save of it
+OPTIONAL_SCHEMA = {
+    'spotify_id': 'category',
+    'name': 'category',
+}
+
+DATE_COLUMNS = ['snapshot_date', 'album_release_date']
+
+# Re-saved exports write "20 03 2025"; the upstream file uses ISO dates and
+# album releases are sometimes only known to the year
+DATE_FORMATS = ['%d %m %Y', '%Y-%m-%d', '%Y']
+
+
+def read_raw(source, **kwargs):
+    return pd.read_csv(source, dtype={**SCHEMA, **OPTIONAL_SCHEMA}, **kwargs)
+
+
+def compression_of(path):
+    with open(path, 'rb') as f:
+        head = f.read(4)
+    for magic, kind in MAGIC_BYTES.items():
+        if head.startswith(magic):
+            return kind
+    return None
+
+
+@contextmanager
+def open_csv(path):
+    # The CSV text of a plain, gzip, zip or zstd file as a binary stream that
+    # decompresses as it is read; nothing is extracted to disk
+    kind = compression_of(path)
+    closers = []
+    if kind is None:
+        stream = open(path, 'rb')
+    elif kind == 'gzip':
+        stream = gzip.open(path, 'rb')
+    elif kind == 'zip':
+        archive = zipfile.ZipFile(path)
+        closers.append(archive)
+        members = [info for info in archive.infolist() if not info.is_dir()]
+        # The first CSV member, or the only file of an archive without one
+        csvs = [info for info in members if info.filename.lower().endswith('.csv')] or members[:1]
+        if not csvs:
+            archive.close()
+            raise ValueError(f"{path} contains no files")
+        stream = archive.open(csvs[0])
+    else:
+        if zstandard is None:
+            raise ImportError(f"reading {path} needs the zstandard package")
+        stream = zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+    try:
+        yield stream
+    finally:
+        stream.close()
+        for closer in closers:
+            closer.close()
+
+
+def read_source(path, workers=PARSE_WORKERS):
+    # The whole dump as a raw frame. Compressed files are parsed chunk by
+    # chunk straight off the decompressor, so only the typed columns and one
+    # chunk of text are ever resident
+    if compression_of(path) is None:
+        return read_csv_parallel(path, workers)
+    pieces = {}
+    with open_csv(path) as stream:
+        for chunk in read_raw(stream, chunksize=STREAM_CHUNK_ROWS):
+            # Copied out of the chunk so its parse buffers are freed at once
+            for col in chunk.columns:
+                pieces.setdefault(col, []).append(chunk[col].copy())
+    if not pieces:
+        return read_raw(io.BytesIO(b''), names=list(SCHEMA))
+    # Joined one column at a time, each column's pieces dropped once joined
+    return pd.DataFrame({col: concat_column(pieces.pop(col)) for col in list(pieces)}, copy=False)
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+
+def chunk_rows_for(path, limit_mb):
+    # Rows per chunk from the mean line length of the first MB of CSV text
+    with open_csv(path) as stream:
+        sample = stream.read(1 << 20)
+    line_bytes = len(sample) / max(sample.count(b'\n'), 1)
+    return max(1000, int(limit_mb * 2**20 * CHUNK_SHARE / max(line_bytes, 1)))
+
+
+def read_streaming(path, limit_mb):
+    # Cleans and splits the dump chunk by chunk, so the raw rows are never
+    # all resident; only the fact/track tables accumulate
+    builder = TableBuilder()
+    with open_csv(path) as stream:
+        for chunk in read_raw(stream, chunksize=chunk_rows_for(path, limit_mb)):
+            builder.add(split_frame(clean_frame(chunk)), copy=True)
+            del chunk
+    if builder.tracks is None:
+        return split_frame(clean_frame(read_raw(io.BytesIO(b''), names=list(SCHEMA))))
+    return builder.build()
+
+
+def trajectory_rows():
+    # Rows per trajectory pass under the memory ceiling (None: all at once)
+    if not MEMORY_LIMIT_MB:
+        return None
+    return max(10_000, int(MEMORY_LIMIT_MB * 2**20 * CHUNK_SHARE / TRAJECTORY_ROW_BYTES))
+
+
+def read_table(path):
+    # The dump on disk as cleaned fact/track tables with trajectory columns
+    if not MEMORY_LIMIT_MB:
+        return add_trajectory(split_frame(clean_frame(read_source(path))))
+
+    table = add_trajectory(read_streaming(path, MEMORY_LIMIT_MB), max_rows=trajectory_rows())
+    peak = peak_rss_mb()
+    if peak is not None:
+        print(f"Streamed {len(table):,} rows: peak RSS {peak:.0f} MB (limit {MEMORY_LIMIT_MB} MB)")
+        if peak > MEMORY_LIMIT_MB:
+            print(f"Peak RSS went {peak - MEMORY_LIMIT_MB:.0f} MB over SPOTIFY_MEMORY_LIMIT_MB")
+    return table
+
+
+def _read_header(f):
+    return next(csv.reader([f.readline().decode('utf-8-sig')]))
+
+
+def _line_ranges(path, parts):
+    # [start, end) byte ranges of the rows, cut at line starts. Chart dumps
+    # never break a quoted field across lines, so a line start is a row start
+    with open(path, 'rb') as f:
+        names = _read_header(f)
+        body = f.tell()
+        size = os.fstat(f.fileno()).st_size
+        cuts = [body]
+        for i in range(1, parts):
+            f.seek(max(body + (size - body) * i // parts - 1, cuts[-1]))
+            f.readline()
+            cuts.append(min(f.tell(), size))
+        cuts.append(size)
+    ranges = [(start, end) for start, end in zip(cuts[:-1], cuts[1:]) if end > start]
+    return names, ranges
+
+
+def _parse_range(path, start, end, names):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    return read_raw(io.BytesIO(data), header=None, names=names)
+
+
+def read_csv_parallel(path, workers=PARSE_WORKERS):
+    # Cold loads: parse line-aligned byte ranges in a process pool with the
+    # declared schema and stitch the frames back together in file order
+    if workers <= 1 or os.path.getsize(path) < PARALLEL_MIN_BYTES:
+        return read_raw(path)
+
+    names, ranges = _line_ranges(path, workers)
+    if len(ranges) <= 1:
+        return read_raw(path)
+    try:
+        with ProcessPoolExecutor(max_workers=len(ranges)) as pool:
+            frames = list(pool.map(_parse_range, *zip(*[(path, start, end, names) for start, end in ranges])))
+    except Exception as e:
+        print(f"Error parsing in parallel, reading serially: {str(e)}")
+        return read_raw(path)
+    return concat_frames(frames)
+
+
+def parse_dates(col):
+    # Parse each distinct date string once and broadcast through the codes,
+    # instead of parsing every row
+    col = col.astype('category')
+    categories = pd.Index(col.cat.categories.astype(str))
+    parsed = pd.Series(pd.NaT, index=categories, dtype='datetime64[ns]')
+    for fmt in DATE_FORMATS:
+        missing = parsed.isna()
+        if not missing.any():
+            break
+        parsed[missing] = pd.to_datetime(categories[missing.to_numpy()], format=fmt, errors='coerce')
+
+    codes = col.cat.codes.to_numpy()
+    values = parsed.to_numpy()[codes]
+    values[codes < 0] = np.datetime64('NaT')
+    return pd.Series(values, index=col.index, name=col.name)
+
+
+def _as_category(col):
+    col = col.astype('category')
+    # Keep the old astype(str) behaviour of labelling missing credits "nan"
+    if col.isna().any():
+        if 'nan' not in col.cat.categories:
+            col = col.cat.add_categories('nan')
+        col = col.fillna('nan')
+    return col
+
+
+def _track_labels(artists, name):
+    # Build "artist | name" once per distinct pair rather than per row
+    width = len(name.cat.categories) + 1
+    key = artists.cat.codes.to_numpy().astype(np.int64) * width + name.cat.codes.to_numpy()
+    codes, pairs = pd.factorize(key)
+    labels = pd.Index(artists.cat.categories[pairs // width].astype(str) + " | "
+                      + name.cat.categories[pairs % width].astype(str))
+    if not labels.is_unique:
+        return (artists.astype(str) + " | " + name.astype(str)).astype('category')
+
+    labels_order = np.argsort(labels.to_numpy(), kind='stable')
+    remap = np.empty_like(labels_order)
+    remap[labels_order] = np.arange(len(labels_order))
+    return pd.Series(
+        pd.Categorical.from_codes(remap[codes], categories=labels[labels_order]),
+        index=artists.index,
+    )
+
+
+def clean_frame(df):
+    # Clean & prep columns
+    df.columns = df.columns.str.strip().str.lower().str.replace(" ", "_")
+    for col in DATE_COLUMNS:
+        df[col] = parse_dates(df[col])
+    df['year'] = df['snapshot_date'].dt.year.astype('Int16')
+    df['month'] = df['snapshot_date'].dt.month.astype('Int8')
+
+    # Song label used by the dropdowns; exports without a 'name' column
+    # fall back to the album title so every row still gets a label
+    name = df['name'] if 'name' in df.columns else df['album_name']
+    df['artists'] = _as_category(df['artists'])
+    df['track_id'] = _track_labels(df['artists'], _as_category(name))
+    return df
+
+
+def _hash_file(path, prefix_size=None, block_size=1 << 20):
+    # One pass returning (hash of the first prefix_size bytes, hash of the
+    # whole file), so an append-only change is detected without re-reading
+    digest = hashlib.blake2b(digest_size=16)
+    prefix = None
+    read = 0
+    with open(path, 'rb') as f:
+        while True:
+            size = block_size
+            if prefix_size is not None and read < prefix_size:
+                size = min(size, prefix_size - read)
+            block = f.read(size)
+            if not block:
+                break
+            digest.update(block)
+            read += len(block)
+            if read == prefix_size:
+                prefix = digest.copy().hexdigest()
+    return prefix, digest.hexdigest()
+
+
+def _has_pyarrow():
+    # Parquet parts need pyarrow; without it only the manifest is kept
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _store_dir(path, cache_dir):
+    # One folder per dump location: same-named files in other folders, or the
+    # .zip and .csv of one dump, must not share (and merge into) a cache
+    stem = os.path.splitext(os.path.basename(path))[0]
+    location = hashlib.blake2b(os.path.realpath(path).encode(), digest_size=6).hexdigest()
+    return os.path.join(cache_dir, f"{stem}-{location}")
+
+
+def _same_file(meta, stat):
+    return meta['size'] == stat.st_size and meta['mtime_ns'] == stat.st_mtime_ns
+
+
+def _replace(write, target):
+    # Write next to the target and swap in, so a crashed boot never leaves
+    # a half-written file behind for the other workers
+    tmp_path = f"{target}.{os.getpid()}.tmp"
+    write(tmp_path)
+    os.replace(tmp_path, target)
+
+
+def read_manifest(path, cache_dir=CACHE_DIR):
+    manifest_path = os.path.join(_store_dir(path, cache_dir), "manifest.json")
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    if manifest.get('cache_version') != CACHE_VERSION:
+        return None
+    return manifest
+
+
+def cached_state(path=DATA_PATH, cache_dir=CACHE_DIR):
+    # The manifest, if the cache already reflects the CSV currently on disk
+    manifest = read_manifest(path, cache_dir)
+    if manifest is None or not _same_file(manifest, os.stat(path)):
+        return None
+    return manifest
+
+
+def _write_manifest(manifest, path, cache_dir):
+    def write(tmp_path):
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+
+    store_dir = _store_dir(path, cache_dir)
+    os.makedirs(store_dir, exist_ok=True)
+    _replace(write, os.path.join(store_dir, "manifest.json"))
+
+
+def _write_part(table, path, cache_dir, manifest):
+    if not _has_pyarrow():
+        return
+    name = f"part-{manifest['next_part']:05d}"
+    manifest['next_part'] += 1
+    store_dir = _store_dir(path, cache_dir)
+    os.makedirs(store_dir, exist_ok=True)
+    for kind, frame in [('facts', table.facts), ('tracks', table.tracks)]:
+        _replace(lambda tmp_path: frame.to_parquet(tmp_path, index=False),
+                 os.path.join(store_dir, f"{name}.{kind}.parquet"))
+    manifest['parts'].append(name)
+
+
+def _prune_parts(path, cache_dir, manifest):
+    # Parts left behind by a compaction or rebuild, once the manifest that
+    # no longer lists them is in place
+    store_dir = _store_dir(path, cache_dir)
+    for name in os.listdir(store_dir):
+        if name.startswith("part-") and name.endswith(".parquet") and name.split('.')[0] not in manifest['parts']:
+            os.remove(os.path.join(store_dir, name))
+
+
+def _read_parts(path, cache_dir, manifest):
+    store_dir = _store_dir(path, cache_dir)
+    return concat_tables([
+        ChartTable(pd.read_parquet(os.path.join(store_dir, f"{name}.facts.parquet")),
+                   pd.read_parquet(os.path.join(store_dir, f"{name}.tracks.parquet")))
+        for name in manifest['parts']
+    ])
+
+
+def read_tail(path, offset):
+    # Parse only the rows appended after byte `offset`, reusing the header
+    with open(path, 'rb') as f:
+        names = _read_header(f)
+        f.seek(offset)
+        return read_raw(f, header=None, names=names)
+
+
+def _ends_with_newline(path, size):
+    with open(path, 'rb') as f:
+        f.seek(size - 1)
+        return f.read(1) == b'\n'
+
+
+def _rebuild(path, cache_dir, stat):
+    table = read_table(path)
+    manifest = {
+        'cache_version': CACHE_VERSION,
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'hash': _hash_file(path)[1],
+        'parts': [],
+        'next_part': 0,
+    }
+    _write_part(table, path, cache_dir, manifest)
+    _write_manifest(manifest, path, cache_dir)
+    _prune_parts(path, cache_dir, manifest)
+    return table, manifest
+
+
+# Bring a ChartTable up to date with the CSV on disk. `current`/`state` are
+# a table and the manifest it was loaded from (None on boot). Bytes appended
+# to a plain CSV are parsed on their own and become one more Parquet part;
+# any other change (edited rows, a re-downloaded or compressed dump) rebuilds
+# the cache from scratch.
+# Returns (table, state, new_rows); new_rows is None on boot or a rebuild.
+def sync_dataset(path=DATA_PATH, cache_dir=CACHE_DIR, current=None, state=None):
+    stat = os.stat(path)
+    if state is not None and _same_file(state, stat):
+        return current, state, 0
+
+    manifest = read_manifest(path, cache_dir)
+    known_rows = None if current is None else len(current)
+
+    # Another worker may already have ingested newer days into the cache
+    if manifest is not None and (current is None or state is None or state['hash'] != manifest['hash']):
+        if not manifest['parts']:
+            manifest = None
+        else:
+            current = _read_parts(path, cache_dir, manifest)
+    if manifest is None:
+        table, manifest = _rebuild(path, cache_dir, stat)
+        return table, manifest, None
+
+    if not _same_file(manifest, stat):
+        prefix_hash, full_hash = _hash_file(path, manifest['size'])
+        delta = None
+        if full_hash == manifest['hash']:
+            pass
+        elif (prefix_hash == manifest['hash'] and compression_of(path) is None
+              and _ends_with_newline(path, manifest['size'])):
+            delta = clean_frame(read_tail(path, manifest['size']))
+        else:
+            table, manifest = _rebuild(path, cache_dir, stat)
+            return table, manifest, None
+
+        manifest = dict(manifest, size=stat.st_size, mtime_ns=stat.st_mtime_ns, hash=full_hash,
+                        parts=list(manifest['parts']))
+        if delta is not None and len(delta):
+            delta = split_frame(delta)
+            # New days extend the trajectory columns from the recent history;
+            # days landing before the newest cached one rewrite them all
+            backfill = delta['snapshot_date'].min() <= current['snapshot_date'].max()
+            if backfill:
+                current = add_trajectory(concat_tables([current.drop(columns=TRAJECTORY_COLUMNS), delta]),
+                                         max_rows=trajectory_rows())
+            else:
+                current = concat_tables([current, add_trajectory(delta, current)])
+            if backfill or len(manifest['parts']) >= MAX_PARTS:
+                # Compact the appended parts (or the rewritten frame) into a single file
+                manifest['parts'] = []
+                _write_part(current, path, cache_dir, manifest)
+            else:
+                _write_part(delta, path, cache_dir, manifest)
+        _write_manifest(manifest, path, cache_dir)
+        _prune_parts(path, cache_dir, manifest)
+
+    new_rows = None if known_rows is None else len(current) - known_rows
+    return current, manifest, new_rows
+
+
+def load_tables(path=DATA_PATH, cache_dir=CACHE_DIR, use_cache=True):
+    if not use_cache:
+        return read_table(path)
+    return sync_dataset(path, cache_dir)[0]
+
+
+def load_dataset(path=DATA_PATH, cache_dir=CACHE_DIR, use_cache=True):
+    # One wide frame with the track columns joined back onto every chart row
+    return load_tables(path, cache_dir, use_cache).frame()
@@ -0,0 +1,73 @@
+import functools
+import threading
+from collections import OrderedDict
+
+
+# Bounded LRU of built figures keyed on (callback name, arguments). Every
+# entry also records the dataset version it was built from, so bumping the
+# version after a reload drops stale figures on their next lookup.
+class FigureCache:
+    def __init__(self, max_entries=128):
+        self.max_entries = max_entries
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def bump_version(self):
+        with self._lock:
+            self.version += 1
+            self._entries.clear()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != self.version:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value, version=None):
+        # `version` is the one the build started from; a figure built on data
+        # that was reloaded meanwhile is dropped instead of stored as fresh
+        with self._lock:
+            if version is None:
+                version = self.version
+            elif version != self.version:
+                return
+            self._entries[key] = (version, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'version': self.version,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def memoize(self, func):
+        # Figures are returned as-is, so callers must not mutate them
+        @functools.wraps(func)
+        def wrapper(*args):
+            key = (func.__name__,) + args
+            value = self.get(key)
+            if value is None:
+                version = self.version
+                value = func(*args)
+                self.put(key, value, version)
+            return value
+        return wrapper
+
+
+figure_cache = FigureCache()
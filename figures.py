@@ -0,0 +1,183 @@
+import os
+
+import numpy as np
+import plotly.express as px
+import plotly.graph_objects as go
+
+from jobs import report_progress
+from metrics import lap
+
+# Above this many points the scatter plot stops sending raw chart rows
+SCATTER_POINT_BUDGET = int(os.environ.get("SCATTER_POINT_BUDGET", 20000))
+SCATTER_BINS = 100
+
+MAP_HOVER = ("<b>%{text}</b><br>popularity=%{z:.1f}<br>max_popularity=%{customdata[0]}"
+             "<br>entries=%{customdata[1]}<extra></extra>")
+
+
+def _base_map_layout():
+    fig = go.Figure(layout={
+        'title': 'Popularity by Country',
+        'coloraxis': {'colorscale': px.colors.sequential.Cividis, 'colorbar': {'title': {'text': 'popularity'}}},
+        'geo': {'showframe': False},
+        'paper_bgcolor': '#282828',
+        'plot_bgcolor': '#282828',
+        'font_color': '#FFFFFF',
+        'margin': dict(l=20, r=20, t=40, b=20),
+    })
+    return fig.to_plotly_json()['layout']
+
+
+# Styled geo layout (template included) built once; every map callback only
+# swaps in a new choropleth trace, so this dict must never be mutated
+MAP_LAYOUT = _base_map_layout()
+
+
+def _global_note(row):
+    # The global chart has no country to shade, so it is reported beside the map
+    return [{
+        'text': (f"Global chart: popularity {row['popularity']:.1f}, "
+                 f"max {row['max_popularity']}, {row['entries']} entries"),
+        'xref': 'paper', 'yref': 'paper', 'x': 0, 'y': 0,
+        'xanchor': 'left', 'yanchor': 'bottom', 'showarrow': False,
+    }]
+
+
+def map_figure(entities, countries, global_chart):
+    # countries/global_chart: by_country()/global_chart() output of a
+    # selection. Each entity gets its own choropleth trace on the shared
+    # colour axis; with several, a dropdown on the map toggles between them
+    # in the browser. Codes that could not be resolved have nothing to draw.
+    countries = countries[countries['iso3'].notna()]
+    traces, notes = [], []
+    for entity in entities:
+        rows = countries[countries['entity'] == entity]
+        traces.append({
+            'type': 'choropleth',
+            'name': entity,
+            'visible': not traces,
+            'locationmode': 'ISO-3',
+            'locations': rows['iso3'].to_numpy(),
+            'z': rows['popularity'].to_numpy(),
+            'text': rows['country'].to_numpy(),
+            'customdata': rows[['max_popularity', 'entries']].to_numpy(),
+            'hovertemplate': MAP_HOVER,
+            'coloraxis': 'coloraxis',
+        })
+        charted = global_chart[global_chart['entity'] == entity]
+        notes.append(_global_note(charted.iloc[0]) if len(charted) else [])
+
+    layout = MAP_LAYOUT
+    if notes and notes[0]:
+        layout = dict(layout, annotations=notes[0])
+    if len(traces) > 1:
+        layout = dict(layout, updatemenus=[{
+            'buttons': [
+                {'label': entity, 'method': 'update',
+                 'args': [{'visible': [i == j for j in range(len(traces))]}, {'annotations': notes[i]}]}
+                for i, entity in enumerate(entities)
+            ],
+            'x': 0, 'y': 1, 'xanchor': 'left', 'yanchor': 'top',
+            'bgcolor': '#282828', 'font': {'color': '#FFFFFF'},
+        }])
+    return {'data': traces, 'layout': layout}
+
+
+TRAJECTORY_HOVER = ("<b>%{fullData.name}</b><br>%{x|%Y-%m-%d}: rank %{y}<br>7d mean rank=%{customdata[0]:.1f}"
+                    "<br>velocity=%{customdata[1]:+.1f}/day<br>days on chart=%{customdata[2]}"
+                    "<br>peak rank=%{customdata[3]}<extra></extra>")
+
+
+def trajectory_figure(entities, days, chart_name):
+    # days: chart_days() output of a selection. Each entity's daily rank and
+    # its 7-day rolling mean, rank 1 at the top
+    traces = []
+    for i, entity in enumerate(entities):
+        rows = days[days['entity'] == entity]
+        colour = '#1DB954' if len(entities) == 1 else px.colors.qualitative.Plotly[i % 10]
+        traces.append({
+            'type': 'scatter', 'mode': 'lines+markers', 'name': entity,
+            'x': rows['snapshot_date'].to_numpy(), 'y': rows['daily_rank'].to_numpy(),
+            'customdata': rows[['rank_7d', 'rank_velocity', 'days_on_chart', 'peak_rank']].to_numpy(),
+            'hovertemplate': TRAJECTORY_HOVER,
+            'line': {'color': colour}, 'marker': {'size': 4},
+        })
+        traces.append({
+            'type': 'scatter', 'mode': 'lines', 'name': f"{entity} (7d mean)",
+            'x': rows['snapshot_date'].to_numpy(), 'y': rows['rank_7d'].to_numpy(),
+            'hoverinfo': 'skip', 'line': {'color': colour, 'dash': 'dot'},
+        })
+    return {'data': traces, 'layout': {
+        'title': {'text': f"Chart Trajectory ({chart_name})"},
+        'template': MAP_LAYOUT['template'],
+        'xaxis': {'title': {'text': 'Date'}},
+        'yaxis': {'title': {'text': 'Daily Rank'}, 'autorange': 'reversed'},
+        'paper_bgcolor': '#282828',
+        'plot_bgcolor': '#282828',
+        'font': {'color': '#FFFFFF'},
+        'margin': dict(l=20, r=20, t=40, b=20),
+    }}
+
+
+def scatter_mode(df, budget=SCATTER_POINT_BUDGET):
+    # Raw rows if they fit, else one point per track, else a 2D density grid
+    if len(df) <= budget:
+        return 'points'
+    if df['track_id'].nunique() <= budget:
+        return 'tracks'
+    return 'density'
+
+
+def _per_track(df, x_attr, y_attr):
+    columns = list(dict.fromkeys([x_attr, y_attr, 'popularity']))
+    return df.groupby('track_id', observed=True)[columns].mean().reset_index()
+
+
+def _density(df, x_attr, y_attr, bins=SCATTER_BINS):
+    x = df[x_attr].to_numpy(dtype='float64')
+    y = df[y_attr].to_numpy(dtype='float64')
+    finite = np.isfinite(x) & np.isfinite(y)
+    counts, x_edges, y_edges = np.histogram2d(x[finite], y[finite], bins=bins)
+    x_centers = (x_edges[:-1] + x_edges[1:]) / 2
+    y_centers = (y_edges[:-1] + y_edges[1:]) / 2
+    # Empty bins stay transparent instead of painting the lowest colour
+    z = np.where(counts > 0, counts, np.nan).T
+    return x_centers, y_centers, z
+
+
+def scatter_data(df, x_attr, y_attr, budget=SCATTER_POINT_BUDGET):
+    # (mode, what that mode plots, chart rows behind it) for scatter_plot
+    mode = scatter_mode(df, budget)
+    report_progress(f"Plotting {len(df):,} rows as {mode}…")
+    if mode == 'points':
+        return mode, df, len(df)
+    data = _per_track(df, x_attr, y_attr) if mode == 'tracks' else _density(df, x_attr, y_attr)
+    lap('aggregate')
+    return mode, data, len(df)
+
+
+def scatter_plot(mode, data, rows, x_attr, y_attr):
+    title = f"{x_attr.capitalize()} vs {y_attr.capitalize()}"
+
+    if mode == 'points':
+        fig = px.scatter(data, x=x_attr, y=y_attr, color='popularity', color_continuous_scale='cividis',
+                         hover_name='artists', title=f"{title} ({rows:,} points)")
+    elif mode == 'tracks':
+        fig = px.scatter(data, x=x_attr, y=y_attr, color='popularity', color_continuous_scale='cividis',
+                         hover_name='track_id',
+                         title=f"{title} ({len(data):,} tracks, one point per track)")
+    else:
+        x_centers, y_centers, z = data
+        fig = go.Figure(go.Heatmap(x=x_centers, y=y_centers, z=z, colorscale='cividis',
+                                   colorbar={'title': 'Rows'}))
+        fig.update_layout(title=f"{title} ({rows:,} rows, density)",
+                          xaxis_title=x_attr, yaxis_title=y_attr)
+
+    fig.update_layout(
+        paper_bgcolor='#282828',
+        plot_bgcolor='#282828',
+        font_color='#FFFFFF',
+        margin=dict(l=20, r=20, t=40, b=20)
+    )
+    lap('figure')
+    return fig
@@ -0,0 +1,117 @@
+import numpy as np
+import pandas as pd
+
+
+def to_date_ns(dates):
+    return np.asarray(dates, dtype='datetime64[ns]').view('int64')
+
+
+def date_span(dates, lo, hi, start_date=None, end_date=None):
+    # Narrow [lo, hi) of a date-sorted block to the inclusive date window
+    block = dates[lo:hi]
+    if start_date is not None:
+        lo += np.searchsorted(block, pd.Timestamp(start_date).value, side='left')
+    if end_date is not None:
+        hi -= len(block) - np.searchsorted(block, pd.Timestamp(end_date).value, side='right')
+    return lo, max(lo, hi)
+
+
+# Normalised artist -> chart row bridge. Each distinct credit string such as
+# "Lady Gaga, Bruno Mars" is split once, then every row is expanded into one
+# (row, artist) pair per credited artist with integer codes, so the artist
+# view, its dropdown and its aggregates all see collaborations.
+class ArtistBridge:
+    def __init__(self, credits, separator=', '):
+        credits = credits.astype('category')
+        pairs = (
+            pd.Series(credits.cat.categories.astype(str)).str.split(separator).explode().str.strip()
+            .loc[lambda names: names != ''].reset_index()
+            .drop_duplicates()
+        )
+        pairs.columns = ['credit', 'artist']
+        self.names = pd.Index(sorted(pairs['artist'].unique()))
+
+        # Artists of credit c are artist_codes[offsets[c]:offsets[c + 1]]
+        pairs = pairs.sort_values('credit', kind='stable')
+        artist_codes = self.names.get_indexer(pairs['artist'])
+        per_credit = np.bincount(pairs['credit'], minlength=len(credits.cat.categories))
+        offsets = np.concatenate([[0], np.cumsum(per_credit)])
+
+        codes = credits.cat.codes.to_numpy()
+        lengths = np.where(codes >= 0, per_credit[codes], 0)
+        self.rows = np.repeat(np.arange(len(codes)), lengths)
+        within = np.arange(len(self.rows)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        self.codes = artist_codes[offsets[codes[self.rows]] + within]
+
+    def keys(self):
+        # One categorical artist name per (row, artist) pair
+        return pd.Series(pd.Categorical.from_codes(self.codes, self.names))
+
+
+# Row positions of every track/artist, grouped by entity and sorted by date.
+# Built once at load time so a callback slices one entity's rows and
+# binary-searches its date window instead of scanning the whole frame.
+# keys/dates may also be bridge pairs, with rows giving each pair's frame row.
+class EntityIndex:
+    def __init__(self, keys, dates, rows=None):
+        keys = keys.astype('category')
+        self.categories = keys.cat.categories
+        codes = keys.cat.codes.to_numpy()
+        date_ns = to_date_ns(dates)
+
+        # Rows without an entity or a snapshot date can never match a filter
+        valid = np.flatnonzero((codes >= 0) & ~np.isnat(date_ns.view('datetime64[ns]')))
+        order = valid[np.lexsort((date_ns[valid], codes[valid]))]
+
+        counts = np.bincount(codes[order], minlength=len(self.categories))
+        self.offsets = np.concatenate([[0], np.cumsum(counts)])
+        self.positions = order if rows is None else rows[order]
+        self.dates = date_ns[order]
+
+    def _span(self, entity):
+        code = self.categories.get_indexer([entity])[0]
+        if code < 0:
+            return 0, 0
+        return self.offsets[code], self.offsets[code + 1]
+
+    def block(self, entity):
+        # All of an entity's row positions with their dates, in date order
+        lo, hi = self._span(entity)
+        return self.positions[lo:hi], self.dates[lo:hi]
+
+    def rows(self, entity, start_date=None, end_date=None):
+        lo, hi = date_span(self.dates, *self._span(entity), start_date, end_date)
+        return self.positions[lo:hi]
+
+    def count(self, entity):
+        lo, hi = self._span(entity)
+        return hi - lo
+
+
+# Sorted entity names with a case-insensitive prefix/substring search, so the
+# dropdown only ever ships a handful of matching options to the browser.
+class SearchIndex:
+    def __init__(self, names):
+        names = pd.Series(names).dropna().astype(str).unique()
+        self.labels = np.array(sorted(names), dtype=object)
+        lowered = pd.Series(self.labels).str.lower()
+        self._lowered = lowered
+        self._order = np.argsort(lowered.to_numpy(), kind='stable')
+        self._lowered_sorted = lowered.to_numpy()[self._order]
+
+    def search(self, query, limit=50):
+        if not query:
+            return self.labels[:limit].tolist()
+
+        query = query.lower()
+        # Prefix hits come from a binary search over the lower-cased names
+        lo = np.searchsorted(self._lowered_sorted, query, side='left')
+        hi = np.searchsorted(self._lowered_sorted, query + '\uffff', side='left')
+        matches = np.sort(self._order[lo:hi])[:limit]
+
+        # Top up with substring hits elsewhere in the name
+        if len(matches) < limit:
+            inner = np.flatnonzero(self._lowered.str.contains(query, regex=False).to_numpy())
+            inner = inner[~np.isin(inner, matches)]
+            matches = np.concatenate([matches, inner[:limit - len(matches)]])
+        return self.labels[matches.astype('int64')].tolist()
@@ -0,0 +1,113 @@
+import functools
+import os
+import time
+from contextlib import contextmanager
+
+from data_loader import CACHE_DIR
+
+try:
+    import fcntl
+except ImportError:  # Windows has no flock; jobs then run uncapped
+    fcntl = None
+
+try:
+    import diskcache
+    from dash import DiskcacheManager
+except ImportError:  # Without diskcache (+ multiprocess, psutil) callbacks stay synchronous
+    diskcache = None
+
+# Job queue/results live on local disk, no broker needed
+JOBS_DIR = os.environ.get("SPOTIFY_JOBS_DIR", os.path.join(CACHE_DIR, "jobs"))
+
+# Heavy figure builds allowed to run at once across all workers
+MAX_JOBS = int(os.environ.get("SPOTIFY_MAX_JOBS", max(1, (os.cpu_count() or 2) // 2)))
+
+# Callback metric samples from job processes waiting for a web worker to read them
+METRICS_SPOOL = 4096
+
+_progress = {'set': None}
+
+
+if diskcache is not None:
+    # Dash starts a job for every request and returns a cached result on its
+    # first poll, so a hit is a finished result already stored for the key.
+    # Counts live in the shared cache, so every worker reports the same ones.
+    class JobManager(DiskcacheManager):
+        def call_job_fn(self, key, job_fn, args, context):
+            self.handle.incr('stats-hits' if self.result_ready(key) else 'stats-misses')
+            return super().call_job_fn(key, job_fn, args, context)
+
+        def stats(self):
+            # Finished results only, not progress or side-update entries
+            entries = sum(1 for key in self.handle.iterkeys()
+                          if not key.startswith('stats-') and not key.endswith(('-progress', '-set_props')))
+            return {
+                'entries': entries,
+                'bytes': self.handle.volume(),
+                'hits': self.handle.get('stats-hits', 0),
+                'misses': self.handle.get('stats-misses', 0),
+            }
+
+        def metrics_spool(self):
+            return diskcache.Deque(directory=os.path.join(JOBS_DIR, "metrics"), maxlen=METRICS_SPOOL)
+
+
+def make_manager(cache_by=None):
+    # Background callback manager, or None to run heavy callbacks inline
+    if diskcache is None or os.environ.get("SPOTIFY_BACKGROUND", "1") == "0":
+        return None
+    return JobManager(diskcache.Cache(JOBS_DIR), cache_by=cache_by)
+
+
+def report_progress(message):
+    # Shown under the chart while a background job runs; no-op inline
+    if _progress['set'] is not None:
+        _progress['set'](message)
+
+
+@contextmanager
+def job_slot(on_wait=None, poll=0.2):
+    # One flock'd file per slot caps concurrent jobs across every process
+    if fcntl is None:
+        yield
+        return
+
+    slots_dir = os.path.join(JOBS_DIR, "slots")
+    os.makedirs(slots_dir, exist_ok=True)
+    while True:
+        for slot in range(MAX_JOBS):
+            f = open(os.path.join(slots_dir, f"slot-{slot}.lock"), 'a')
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                f.close()
+                continue
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+                f.close()
+            return
+        if on_wait is not None:
+            on_wait()
+        time.sleep(poll)
+
+
+def heavy_callback(app, manager, *dependencies, progress=None, running=None):
+    # Register an expensive callback as a Dash background callback. Dash
+    # terminates a still-running job when the same callback fires again, so
+    # superseded requests are cancelled; job_slot() caps how many run at once.
+    def decorator(func):
+        if manager is None:
+            return app.callback(*dependencies)(func)
+
+        @functools.wraps(func)
+        def job(set_progress, *args):
+            _progress['set'] = set_progress
+            with job_slot(on_wait=lambda: set_progress("Waiting for a free worker…")):
+                set_progress("Rendering…")
+                return func(*args)
+
+        return app.callback(*dependencies, background=True, manager=manager,
+                            progress=progress, running=running)(job)
+    return decorator
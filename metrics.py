@@ -0,0 +1,190 @@
+import functools
+import json
+import os
+import threading
+import time
+from collections import defaultdict, deque
+
+import numpy as np
+from plotly.utils import PlotlyJSONEncoder
+
+# Samples kept per callback for the rolling percentiles
+WINDOW = int(os.environ.get("SPOTIFY_METRICS_WINDOW", 1024))
+
+# Log callbacks slower than this many milliseconds (unset disables)
+SLOW_CALLBACK_MS = os.environ.get("SPOTIFY_SLOW_CALLBACK_MS")
+
+PHASES = ['filter', 'aggregate', 'figure', 'serialize']
+QUANTILES = [0.5, 0.9, 0.99]
+
+
+class CallbackMetrics:
+    def __init__(self, window=WINDOW, slow_ms=SLOW_CALLBACK_MS):
+        self.window = window
+        self.slow_ms = None if slow_ms in (None, '') else float(slow_ms)
+        self._samples = defaultdict(lambda: deque(maxlen=self.window))
+        # Lifetime (count, sum) per callback and phase/bytes, for the
+        # Prometheus summary _count/_sum series
+        self._totals = defaultdict(dict)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.spool = None
+        self._pid = os.getpid()
+
+    def share(self, spool):
+        # Background jobs run in forked processes whose samples would die
+        # with them; they go to spool (a diskcache.Deque) instead and are
+        # merged into the window of whichever worker reads the metrics next
+        self.spool = spool
+        self._pid = os.getpid()
+
+    def _in_job(self):
+        return self.spool is not None and os.getpid() != self._pid
+
+    def lap(self, name):
+        # Attribute the time since the previous lap (or the callback start)
+        # to one phase of the running callback; repeated names add up
+        record = getattr(self._local, 'record', None)
+        if record is None:
+            return
+        now = time.perf_counter()
+        record['phases'][name] = record['phases'].get(name, 0.0) + now - record['lap']
+        record['lap'] = now
+
+    def instrument(self, func):
+        @functools.wraps(func)
+        def wrapper(*args):
+            record = {
+                'callback': func.__name__,
+                'inputs': args,
+                'phases': {},
+                'start': time.perf_counter(),
+            }
+            record['lap'] = record['start']
+            self._local.record = record
+            result = None
+            try:
+                result = func(*args)
+                return result
+            finally:
+                self._local.record = None
+                record['end'] = time.perf_counter()
+                # Inside a Dash request the after_request hook adds the
+                # JSON encoding/compression time to the serialize phase and
+                # the response size before recording
+                if self._in_job():
+                    # A job has no response (its request state is only a
+                    # copy from the fork); the result's JSON size before
+                    # compression stands in for the bytes sent
+                    self._record(record, len(json.dumps(result, cls=PlotlyJSONEncoder)))
+                elif getattr(self._local, 'in_request', False):
+                    self._local.pending = record
+                else:
+                    self._record(record, None)
+        return wrapper
+
+    def init_app(self, server):
+        @server.before_request
+        def start_request():
+            self._local.in_request = True
+            self._local.pending = None
+
+        @server.after_request
+        def finish_request(response):
+            record = getattr(self._local, 'pending', None)
+            self._local.in_request = False
+            self._local.pending = None
+            if record is not None:
+                phases = record['phases']
+                phases['serialize'] = phases.get('serialize', 0.0) + time.perf_counter() - record['end']
+                self._record(record, response.calculate_content_length())
+            return response
+
+        @server.route('/metrics')
+        def prometheus_metrics():
+            return self.render(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+    def _record(self, record, output_bytes):
+        total = time.perf_counter() - record['start']
+        sample = {'total': total, 'bytes': output_bytes, **record['phases']}
+        if self._in_job():
+            self.spool.append((record['callback'], sample))
+        else:
+            self._add(record['callback'], sample)
+
+        if self.slow_ms is not None and total * 1000 >= self.slow_ms:
+            phases = ", ".join(f"{name}={seconds * 1000:.1f}ms" for name, seconds in record['phases'].items())
+            print(f"Slow callback {record['callback']} took {total * 1000:.1f}ms "
+                  f"({phases}; {output_bytes} bytes) inputs={json.dumps(record['inputs'], default=str)}")
+
+    def _add(self, name, sample):
+        with self._lock:
+            self._samples[name].append(sample)
+            totals = self._totals[name]
+            for key in ['total', 'bytes'] + PHASES:
+                if sample.get(key) is not None:
+                    count, total = totals.get(key, (0, 0))
+                    totals[key] = (count + 1, total + sample[key])
+
+    def _drain(self):
+        if self.spool is None:
+            return
+        while True:
+            try:
+                name, sample = self.spool.popleft()
+            except IndexError:
+                break
+            self._add(name, sample)
+
+    def summary(self):
+        self._drain()
+        with self._lock:
+            samples = {name: list(values) for name, values in self._samples.items()}
+            totals = {name: dict(values) for name, values in self._totals.items()}
+
+        summary = {}
+        for name, values in samples.items():
+            count, total = totals[name]['total']
+            stats = {'count': count, 'sum': total, 'totals': totals[name], 'seconds': {}, 'bytes': {}}
+            for key in ['total'] + PHASES:
+                observed = [sample[key] for sample in values if sample.get(key) is not None]
+                if observed:
+                    stats['seconds'][key] = dict(zip(QUANTILES, np.quantile(observed, QUANTILES)))
+            sizes = [sample['bytes'] for sample in values if sample['bytes'] is not None]
+            if sizes:
+                stats['bytes'] = dict(zip(QUANTILES, np.quantile(sizes, QUANTILES)))
+            summary[name] = stats
+        return summary
+
+    def render(self):
+        # Prometheus text exposition format
+        lines = [
+            "# HELP dash_callback_seconds Wall time of Dash callbacks by phase over the recent window.",
+            "# TYPE dash_callback_seconds summary",
+        ]
+        summary = self.summary()
+        for name, stats in summary.items():
+            for phase, quantiles in stats['seconds'].items():
+                for q, value in quantiles.items():
+                    lines.append(f'dash_callback_seconds{{callback="{name}",phase="{phase}",quantile="{q}"}} {value:.6f}')
+                count, total = stats['totals'][phase]
+                lines.append(f'dash_callback_seconds_sum{{callback="{name}",phase="{phase}"}} {total:.6f}')
+                lines.append(f'dash_callback_seconds_count{{callback="{name}",phase="{phase}"}} {count}')
+
+        lines += [
+            "# HELP dash_callback_output_bytes Bytes sent for the callback response (after compression) over the recent window.",
+            "# TYPE dash_callback_output_bytes summary",
+        ]
+        for name, stats in summary.items():
+            if not stats['bytes']:
+                continue
+            for q, value in stats['bytes'].items():
+                lines.append(f'dash_callback_output_bytes{{callback="{name}",quantile="{q}"}} {value:.0f}')
+            count, total = stats['totals']['bytes']
+            lines.append(f'dash_callback_output_bytes_sum{{callback="{name}"}} {total}')
+            lines.append(f'dash_callback_output_bytes_count{{callback="{name}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+
+callback_metrics = CallbackMetrics()
+lap = callback_metrics.lap
@@ -0,0 +1,385 @@
+import os
+import sqlite3
+import threading
+
+import numpy as np
+import pandas as pd
+
+try:
+    import duckdb
+except ImportError:  # The 'duckdb' backend then falls back to sqlite
+    duckdb = None
+
+from countries import iso3_codes
+from figures import SCATTER_BINS, SCATTER_POINT_BUDGET, scatter_data
+from indexes import ArtistBridge, to_date_ns
+from jobs import report_progress
+from metrics import lap
+from selection import entity_list, selection_cache
+from shared_data import file_lock
+from trajectory import NS_PER_DAY
+
+# Which engine answers the map, daily series, bar chart and scatter queries:
+# 'memory' (the in-process indexes and aggregates), or 'sqlite'/'duckdb' (a
+# local database file built next to the columnar cache, queried with
+# parameterised SQL so the aggregation scratch lives in the engine)
+QUERY_BACKEND = os.environ.get("SPOTIFY_QUERY_BACKEND", "memory")
+
+# Bump whenever the database schema changes
+QUERY_VERSION = 2
+
+# Chart rows written per insert while building the database
+INSERT_ROWS = 200_000
+
+CHART_COLUMNS = ['track', 'country', 'day', 'daily_rank', 'popularity']
+
+SCHEMA_SQL = [
+    "CREATE TABLE charts (track INTEGER, country VARCHAR, day INTEGER, daily_rank INTEGER, popularity INTEGER)",
+    "CREATE TABLE credits (artist VARCHAR, track INTEGER)",
+]
+
+# Created after the rows are in, which is much faster than keeping them up
+# to date per insert. Artists are credited per track, so (artist, date)
+# lookups go through credits(artist, track) and then charts(track, day)
+INDEX_SQL = [
+    "CREATE INDEX charts_track_day ON charts (track, day)",
+    "CREATE INDEX charts_country_day ON charts (country, day)",
+    "CREATE INDEX credits_artist_track ON credits (artist, track)",
+    "CREATE INDEX tracks_track_id ON tracks (track_id)",
+]
+
+
+def query_engine(backend=QUERY_BACKEND):
+    # 'memory', 'sqlite' or 'duckdb'; unknown names stay in memory
+    if backend == 'duckdb' and duckdb is None:
+        return 'sqlite'
+    return backend if backend in ('sqlite', 'duckdb') else 'memory'
+
+
+def _connect(path, engine, read_only=True):
+    if engine == 'duckdb':
+        return duckdb.connect(path, read_only=read_only)
+    if read_only:
+        return sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+    return sqlite3.connect(path)
+
+
+def _insert(conn, engine, name, frame):
+    if engine == 'duckdb':
+        conn.register('part', frame)
+        conn.execute(f"INSERT INTO {name} SELECT * FROM part")
+        conn.unregister('part')
+    else:
+        frame.to_sql(name, conn, if_exists='append', index=False)
+
+
+def _strings(values):
+    # Object array with None for missing values, which both engines store as NULL
+    values = np.asarray(values, dtype=object)
+    values[pd.isna(values)] = None
+    return values
+
+
+def _chart_rows(table, start, stop):
+    date_ns = to_date_ns(table.facts['snapshot_date'].iloc[start:stop])
+    day = pd.array(date_ns // NS_PER_DAY, dtype='Int32')
+    day[np.isnat(date_ns.view('datetime64[ns]'))] = pd.NA
+    return pd.DataFrame({
+        'track': table.track[start:stop].astype('int64'),
+        'country': _strings(table.facts['country'].iloc[start:stop]),
+        'day': day,
+        'daily_rank': table.facts['daily_rank'].to_numpy()[start:stop].astype('int64'),
+        'popularity': table.facts['popularity'].to_numpy()[start:stop].astype('int64'),
+    })
+
+
+def build_database(table, path, engine, features):
+    # Same fact/track split as the ChartTable: chart rows point at one row per
+    # track description, which also carries its chart row count and
+    # popularity total so per-row means never have to scan the chart rows
+    tmp = f"{path}.tmp"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    conn = _connect(tmp, engine, read_only=False)
+    try:
+        for sql in SCHEMA_SQL:
+            conn.execute(sql)
+        conn.execute("CREATE TABLE tracks (track INTEGER, track_id VARCHAR, artists VARCHAR, rows INTEGER, "
+                     "popularity_total DOUBLE, popularity_rows INTEGER, "
+                     + ", ".join(f'"{name}" DOUBLE' for name in features) + ")")
+
+        for start in range(0, len(table), INSERT_ROWS):
+            _insert(conn, engine, 'charts', _chart_rows(table, start, start + INSERT_ROWS))
+
+        tracks = pd.DataFrame({
+            'track': np.arange(len(table.tracks), dtype='int64'),
+            'track_id': _strings(table.tracks['track_id']),
+            'artists': _strings(table.tracks['artists']),
+            'rows': np.bincount(table.track, minlength=len(table.tracks)).astype('int64'),
+        })
+        popularity = table.facts['popularity'].to_numpy(dtype='float64')
+        valid = ~np.isnan(popularity)
+        tracks['popularity_total'] = np.bincount(table.track[valid], weights=popularity[valid], minlength=len(tracks))
+        tracks['popularity_rows'] = np.bincount(table.track[valid], minlength=len(tracks)).astype('int64')
+        for name in features:
+            tracks[name] = table.tracks[name].to_numpy(dtype='float64')
+        _insert(conn, engine, 'tracks', tracks)
+
+        bridge = ArtistBridge(table.tracks['artists'])
+        _insert(conn, engine, 'credits', pd.DataFrame({
+            'artist': bridge.names[bridge.codes].astype(object),
+            'track': bridge.rows.astype('int64'),
+        }))
+
+        for sql in INDEX_SQL:
+            conn.execute(sql)
+        conn.commit()
+    finally:
+        conn.close()
+    os.replace(tmp, path)
+
+
+def _day(date):
+    return None if date is None else pd.Timestamp(date).value // NS_PER_DAY
+
+
+def _marks(values):
+    # Placeholders of an IN list; an empty IN list is an error in some
+    # engines, IN (NULL) matches nothing
+    return ", ".join("?" * len(values)) or "NULL"
+
+
+# Answers the callbacks from the ChartData indexes and aggregates, through
+# the per-session selection cache the other figures share
+class MemoryQueries:
+    def __init__(self, data):
+        self.data = data
+
+    def select(self, view, entities, start_date=None, end_date=None):
+        return selection_cache.select(self.data, view, entities, start_date, end_date)
+
+    def top_tracks(self, attribute, k=10):
+        return self.data.track_features.top_k(attribute, k)
+
+    def scatter_data(self, x_attr, y_attr, budget=SCATTER_POINT_BUDGET):
+        # Only the plotted track columns are joined onto the chart rows
+        columns = list(dict.fromkeys([x_attr, y_attr, 'popularity', 'track_id', 'artists']))
+        return scatter_data(self.data.table[columns], x_attr, y_attr, budget)
+
+
+# The selected songs or artists resolved once to their track codes; the
+# aggregates then read only those tracks' chart rows, through the
+# charts(track, day) index, and combine them per entity
+class SqlSelection:
+    def __init__(self, queries, view, entities, start_date=None, end_date=None):
+        self.queries = queries
+        self.entities = entity_list(entities)
+        self.start_date = start_date
+        self.end_date = end_date
+        if view == 'song':
+            sql = f"SELECT track_id AS entity, track FROM tracks WHERE track_id IN ({_marks(self.entities)})"
+        else:
+            sql = f"SELECT artist AS entity, track FROM credits WHERE artist IN ({_marks(self.entities)})"
+        self.pairs = queries._frame(sql, self.entities)
+        self.pairs['order'] = pd.Index(self.entities).get_indexer(self.pairs['entity'])
+        self.tracks = np.unique(self.pairs['track'].to_numpy(dtype='int64')).tolist()
+
+    def __len__(self):
+        return len(self.tracks)
+
+    def _per_entity(self, keys, values, where):
+        # SUM/MAX/COUNT of `values` per track and keys inside the window,
+        # summed (max-ed) again per entity and keys, in entity order
+        sql, params = f"c.track IN ({_marks(self.tracks)}) AND c.day IS NOT NULL AND {where}", list(self.tracks)
+        if self.start_date is not None:
+            sql += " AND c.day >= ?"
+            params.append(_day(self.start_date))
+        if self.end_date is not None:
+            sql += " AND c.day <= ?"
+            params.append(_day(self.end_date))
+        group = ", ".join(["c.track"] + [f"c.{key}" for key in keys])
+        frame = self.queries._frame(
+            f"SELECT {group}, SUM(c.{values}) AS total, MAX(c.{values}) AS peak, COUNT(c.{values}) AS entries "
+            f"FROM charts c WHERE {sql} GROUP BY {group}",
+            params,
+        )
+        frame = frame.merge(self.pairs, on='track')
+        return (frame.groupby(['order'] + keys, sort=True)
+                .agg(entity=('entity', 'first'), total=('total', 'sum'), peak=('peak', 'max'), entries=('entries', 'sum'))
+                .reset_index())
+
+    def _popularity(self, frame):
+        return pd.DataFrame({
+            'popularity': frame['total'].to_numpy(dtype='float64') / frame['entries'].to_numpy(dtype='float64'),
+            'max_popularity': frame['peak'].to_numpy(dtype='int16'),
+            'entries': frame['entries'].to_numpy(dtype='int32'),
+        })
+
+    def by_country(self):
+        frame = self._per_entity(['country'], 'popularity', "c.country IS NOT NULL")
+        iso3, names = iso3_codes(frame['country'])
+        result = self._popularity(frame)
+        result.insert(0, 'country', names)
+        result.insert(0, 'iso3', iso3)
+        result.insert(0, 'entity', frame['entity'].to_numpy(dtype=object))
+        return result
+
+    def global_chart(self):
+        frame = self._per_entity([], 'popularity', "c.country IS NULL")
+        result = self._popularity(frame)
+        result.insert(0, 'entity', frame['entity'].to_numpy(dtype=object))
+        return result
+
+    def daily_mean(self, name):
+        if name not in CHART_COLUMNS:
+            raise KeyError(name)
+        frame = self._per_entity(['day'], name, "1 = 1")
+        return pd.DataFrame({
+            'entity': frame['entity'].to_numpy(dtype=object),
+            'snapshot_date': (frame['day'].to_numpy(dtype='int64') * NS_PER_DAY).view('datetime64[ns]'),
+            name: frame['total'].to_numpy(dtype='float64') / frame['entries'].to_numpy(dtype='float64'),
+        })
+
+
+# Answers the same queries from a database file built by build_database,
+# with one read-only connection per thread. Results match MemoryQueries up
+# to float rounding and the order of tied values.
+class SqlQueries:
+    def __init__(self, path, engine, features, dtypes):
+        self.path = path
+        self.engine = engine
+        self.features = list(features)
+        # Chart table dtypes of the features and popularity
+        self.dtypes = dtypes
+        self._local = threading.local()
+
+    def _frame(self, sql, params=()):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = _connect(self.path, self.engine)
+        if self.engine == 'duckdb':
+            return conn.execute(sql, list(params)).df()
+        return pd.read_sql_query(sql, conn, params=list(params))
+
+    def _table_dtypes(self, frame, means=False):
+        # Engines return float64/int64, which figures serialise as longer
+        # numbers than the table's own dtypes; means of integer columns stay
+        # float, as they do in pandas
+        for name, dtype in self.dtypes.items():
+            if name in frame.columns and not (means and dtype.kind != 'f'):
+                frame[name] = frame[name].astype(dtype)
+        return frame
+
+    def _feature(self, name):
+        # Column names can't be parameters, so only known features get in
+        if name not in self.features:
+            raise KeyError(name)
+        return f't."{name}"'
+
+    def _features(self, names, aggregate="{}"):
+        # Select list of track features under their own names
+        return ", ".join(f'{aggregate.format(self._feature(name))} AS "{name}"' for name in dict.fromkeys(names))
+
+    def select(self, view, entities, start_date=None, end_date=None):
+        return SqlSelection(self, view, entities, start_date, end_date)
+
+    def top_tracks(self, attribute, k=10):
+        column = self._feature(attribute)
+        return self._frame(
+            f'SELECT t.track_id, SUM({column} * t.rows) / SUM(t.rows) AS "{attribute}" FROM tracks t '
+            f'WHERE t.track_id IS NOT NULL AND {column} IS NOT NULL AND t.rows > 0 '
+            f'GROUP BY t.track_id ORDER BY "{attribute}" DESC, t.track_id LIMIT ?',
+            [k],
+        )
+
+    def scatter_data(self, x_attr, y_attr, budget=SCATTER_POINT_BUDGET):
+        # Same modes as figures.scatter_data, decided from counts; only the
+        # points mode reads chart rows out, the others come back aggregated
+        x, y = self._feature(x_attr), self._feature(y_attr)
+        counts = self._frame("SELECT SUM(rows) AS chart_rows, COUNT(DISTINCT track_id) AS track_ids "
+                             "FROM tracks WHERE rows > 0")
+        rows = int(counts['chart_rows'].fillna(0).iloc[0])
+        if rows <= budget:
+            mode = 'points'
+        elif int(counts['track_ids'].iloc[0]) <= budget:
+            mode = 'tracks'
+        else:
+            mode = 'density'
+        report_progress(f"Plotting {rows:,} rows as {mode}…")
+
+        if mode == 'points':
+            return mode, self._table_dtypes(self._frame(
+                f"SELECT {self._features([x_attr, y_attr])}, c.popularity, t.track_id, t.artists "
+                f"FROM charts c JOIN tracks t ON c.track = t.track")), rows
+
+        if mode == 'tracks':
+            # Means over chart rows per track, like grouping the joined rows,
+            # from each description's row count and popularity total
+            means = "SUM({0} * t.rows) / SUM(CASE WHEN {0} IS NOT NULL THEN t.rows END)"
+            data = self._frame(
+                f"SELECT t.track_id, {self._features([x_attr, y_attr], means)}, "
+                f"SUM(t.popularity_total) / SUM(t.popularity_rows) AS popularity FROM tracks t "
+                f"WHERE t.track_id IS NOT NULL AND t.rows > 0 GROUP BY t.track_id ORDER BY t.track_id")
+            data = self._table_dtypes(data, means=True)
+        else:
+            data = self._density(x, y)
+        lap('aggregate')
+        return mode, data, rows
+
+    def _density(self, x, y, bins=SCATTER_BINS):
+        # Chart rows per grid cell, counted from the track descriptions'
+        # row counts; the grid spans the finite values like histogram2d
+        finite = f"t.rows > 0 AND {x} IS NOT NULL AND {y} IS NOT NULL"
+        bounds = self._frame(f"SELECT MIN({x}) AS x_lo, MAX({x}) AS x_hi, MIN({y}) AS y_lo, MAX({y}) AS y_hi "
+                             f"FROM tracks t WHERE {finite}").iloc[0]
+        edges = []
+        for lo, hi in [(bounds['x_lo'], bounds['x_hi']), (bounds['y_lo'], bounds['y_hi'])]:
+            if pd.isna(lo):
+                lo, hi = 0.0, 1.0
+            elif lo == hi:
+                lo, hi = lo - 0.5, hi + 0.5
+            edges.append(np.linspace(lo, hi, bins + 1))
+        x_edges, y_edges = edges
+
+        # Values are never below the low edge, so truncating is flooring;
+        # DuckDB rounds on CAST, hence FLOOR there
+        cell = "CAST(FLOOR({}) AS INTEGER)" if self.engine == 'duckdb' else "CAST({} AS INTEGER)"
+        cells = self._frame(
+            f"SELECT {cell.format(f'({x} - ?) * ?')} AS x_bin, {cell.format(f'({y} - ?) * ?')} AS y_bin, "
+            f"SUM(t.rows) AS rows FROM tracks t WHERE {finite} GROUP BY x_bin, y_bin",
+            [x_edges[0], bins / (x_edges[-1] - x_edges[0]), y_edges[0], bins / (y_edges[-1] - y_edges[0])],
+        )
+        counts = np.zeros((bins, bins))
+        # The top edge belongs to the last bin
+        np.add.at(counts, (np.minimum(cells['x_bin'].to_numpy(dtype='int64'), bins - 1),
+                           np.minimum(cells['y_bin'].to_numpy(dtype='int64'), bins - 1)),
+                  cells['rows'].to_numpy(dtype='float64'))
+        x_centers = (x_edges[:-1] + x_edges[1:]) / 2
+        y_centers = (y_edges[:-1] + y_edges[1:]) / 2
+        return x_centers, y_centers, np.where(counts > 0, counts, np.nan).T
+
+
+def _database_path(cache_dir, state_hash, engine):
+    return os.path.join(cache_dir, "queries", f"{state_hash}-v{QUERY_VERSION}.{engine}")
+
+
+def open_queries(data, cache_dir, state_hash, features, backend=QUERY_BACKEND):
+    # The query layer for a ChartData; SQL backends build their database
+    # file once per CSV state and drop the files of older states
+    engine = query_engine(backend)
+    if engine != backend:
+        print(f"SPOTIFY_QUERY_BACKEND {backend!r} is not available, using {engine}")
+    if engine == 'memory':
+        return MemoryQueries(data)
+
+    path = _database_path(cache_dir, state_hash, engine)
+    with file_lock(os.path.join(cache_dir, "queries", "build.lock")):
+        if not os.path.exists(path):
+            build_database(data.table, path, engine, features)
+            # Connections already open keep reading their unlinked file
+            for name in os.listdir(os.path.dirname(path)):
+                if name != os.path.basename(path) and not name.endswith(".lock"):
+                    os.remove(os.path.join(os.path.dirname(path), name))
+    dtypes = data.table.tracks[list(features)].dtypes.to_dict()
+    dtypes['popularity'] = data.table.facts['popularity'].dtype
+    return SqlQueries(path, engine, features, dtypes)
@@ -0,0 +1,198 @@
+import os
+import threading
+import uuid
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+from flask import has_request_context, request
+
+from indexes import date_span
+from trajectory import TRAJECTORY_COLUMNS
+
+# Browser sessions whose recent selections are kept
+SESSION_LIMIT = int(os.environ.get("SPOTIFY_SELECTION_SESSIONS", 256))
+
+# Most tracks/artists compared at once
+MAX_COMPARE = int(os.environ.get("SPOTIFY_MAX_COMPARE", 5))
+
+# Entities, date windows and combined selections kept per session
+ENTITIES_PER_SESSION = 16
+WINDOWS_PER_ENTITY = 8
+SELECTIONS_PER_SESSION = 8
+
+SESSION_COOKIE = "spotify_session"
+
+
+def entity_list(entities):
+    # Dropdown value (one name, a list of names or None) as a capped list
+    if entities is None:
+        return []
+    if isinstance(entities, str):
+        return [entities]
+    return list(dict.fromkeys(entities))[:MAX_COMPARE]
+
+
+def _lru_get(entries, key, build, limit):
+    value = entries.get(key)
+    if value is None:
+        value = build()
+        entries[key] = value
+        while len(entries) > limit:
+            entries.popitem(last=False)
+    entries.move_to_end(key)
+    return value
+
+
+# The rows of one or more entities inside one date window, grouped by
+# entity and date-sorted within each. Columns are gathered only when a figure
+# asks for them and then shared by every figure that needs the same column,
+# instead of each figure copying and re-grouping the frame.
+class Selection:
+    def __init__(self, data, view, entities, windows, start_date, end_date):
+        self.data = data
+        self.view = view
+        self.entities = entities
+        self.start_date = start_date
+        self.end_date = end_date
+        self.rows = np.concatenate([rows for rows, _ in windows] + [np.empty(0, dtype='int64')])
+        self.dates = np.concatenate([dates for _, dates in windows] + [np.empty(0, dtype='int64')])
+        self.labels = np.repeat(np.arange(len(windows)), [len(rows) for rows, _ in windows])
+        self._columns = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def column(self, name):
+        with self._lock:
+            values = self._columns.get(name)
+            if values is None:
+                values = self.data.table.take(name, self.rows)
+                self._columns[name] = values
+            return values
+
+    def frame(self, columns):
+        return pd.DataFrame({name: self.column(name) for name in columns})
+
+    def daily_mean(self, name):
+        # Every (entity, day) is one contiguous run, so a single reduceat
+        # averages all selected entities at once
+        breaks = np.flatnonzero((np.diff(self.dates) != 0) | (np.diff(self.labels) != 0)) + 1
+        starts = np.concatenate([[0], breaks]) if len(self.rows) else breaks
+        counts = np.diff(np.append(starts, len(self.rows)))
+        values = self.column(name).astype('float64')
+        return pd.DataFrame({
+            'entity': np.asarray(self.entities, dtype=object)[self.labels[starts]],
+            'snapshot_date': self.dates[starts].view('datetime64[ns]'),
+            name: np.add.reduceat(values, starts) / counts if len(starts) else values,
+        })
+
+    def chart_days(self, country=None):
+        # One row per (entity, day) on one chart (country None: the global
+        # chart): its best ranked row with the trajectory columns the loader
+        # stored, so nothing is recomputed per request
+        countries = self.data.table['country']
+        code = -1 if country is None else countries.cat.categories.get_indexer([country])[0]
+        if country is not None and code < 0:
+            keep = np.empty(0, dtype='int64')
+        else:
+            keep = np.flatnonzero(countries.cat.codes.to_numpy()[self.rows] == code)
+        rank = self.column('daily_rank')[keep]
+        keep = keep[np.lexsort((rank, self.dates[keep], self.labels[keep]))]
+        labels, dates = self.labels[keep], self.dates[keep]
+        first = np.concatenate([[True], (np.diff(dates) != 0) | (np.diff(labels) != 0)]) if len(keep) else np.empty(0, dtype=bool)
+        keep = keep[first]
+        frame = pd.DataFrame({name: self.column(name)[keep] for name in TRAJECTORY_COLUMNS})
+        frame.insert(0, 'daily_rank', self.column('daily_rank')[keep])
+        frame.insert(0, 'snapshot_date', self.dates[keep].view('datetime64[ns]'))
+        frame.insert(0, 'entity', np.asarray(self.entities, dtype=object)[self.labels[keep]])
+        return frame
+
+    def by_country(self):
+        return self.data.cube(self.view).by_country_many(self.entities, self.start_date, self.end_date)
+
+    def global_chart(self):
+        return self.data.cube(self.view).global_chart_many(self.entities, self.start_date, self.end_date)
+
+
+# An entity's full date-sorted block, cut into date windows on demand so that
+# moving only the date pickers reuses it
+class EntitySlice:
+    def __init__(self, data, view, entity):
+        self.positions, self.dates = data.entity_index(view).block(entity)
+        self._windows = OrderedDict()
+        self._lock = threading.Lock()
+
+    def window(self, start_date, end_date):
+        def cut():
+            lo, hi = date_span(self.dates, 0, len(self.dates), start_date, end_date)
+            return self.positions[lo:hi], self.dates[lo:hi]
+
+        with self._lock:
+            return _lru_get(self._windows, (start_date, end_date), cut, WINDOWS_PER_ENTITY)
+
+
+class _Session:
+    def __init__(self):
+        self.entities = OrderedDict()
+        self.selections = OrderedDict()
+
+
+# Per-session LRU of the current selections, keyed on the session cookie so
+# one user's clicks never evict another's slices. Entity slices are cached
+# separately, so adding an entity to a comparison only slices the new one.
+class SelectionCache:
+    def __init__(self, max_sessions=SESSION_LIMIT):
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def init_app(self, server):
+        @server.after_request
+        def assign_session(response):
+            if SESSION_COOKIE not in request.cookies:
+                response.set_cookie(SESSION_COOKIE, uuid.uuid4().hex, httponly=True, samesite='Lax')
+            return response
+
+    def _session(self):
+        if not has_request_context():
+            return None
+        return request.cookies.get(SESSION_COOKIE)
+
+    def select(self, data, view, entities, start_date, end_date):
+        entities = tuple(entity_list(entities))
+        start_date = None if start_date is None else pd.Timestamp(start_date)
+        end_date = None if end_date is None else pd.Timestamp(end_date)
+
+        with self._lock:
+            session = _lru_get(self._sessions, self._session(), _Session, self.max_sessions)
+            slices = [
+                _lru_get(session.entities, (data.version, view, entity),
+                         lambda: EntitySlice(data, view, entity), ENTITIES_PER_SESSION)
+                for entity in entities
+            ]
+            return _lru_get(
+                session.selections, (data.version, view, entities, start_date, end_date),
+                lambda: Selection(data, view, list(entities),
+                                  [entity_slice.window(start_date, end_date) for entity_slice in slices],
+                                  start_date, end_date),
+                SELECTIONS_PER_SESSION,
+            )
+
+    def clear(self):
+        # Selections and slices pin the ChartData they were cut from, so a
+        # refresh drops them all rather than keeping old bundles alive
+        with self._lock:
+            self._sessions.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'sessions': len(self._sessions),
+                'entities': sum(len(session.entities) for session in self._sessions.values()),
+                'selections': sum(len(session.selections) for session in self._sessions.values()),
+            }
+
+
+selection_cache = SelectionCache()
@@ -0,0 +1,79 @@
+import mmap
+import os
+import pickle
+import shutil
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows has no flock; workers then just race to publish
+    fcntl = None
+
+# Buffers are laid out on cache-line boundaries inside buffers.bin
+ALIGNMENT = 64
+
+
+# A published bundle is a pickle (protocol 5) whose NumPy/pandas buffers are
+# written out-of-band to one flat file. Attaching maps that file copy-on-write
+# and hands slices of the mapping back to pickle, so every worker's arrays
+# point at the same page-cache pages instead of private copies.
+def publish(obj, directory):
+    buffers = []
+    payload = pickle.dumps(obj, protocol=5, buffer_callback=buffers.append)
+
+    tmp_dir = f"{directory}.{os.getpid()}.tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    spans = []
+    with open(os.path.join(tmp_dir, "buffers.bin"), 'wb') as f:
+        for buffer in buffers:
+            raw = buffer.raw()
+            offset = -f.tell() % ALIGNMENT
+            f.write(b'\0' * offset)
+            spans.append((f.tell(), raw.nbytes))
+            f.write(raw)
+    with open(os.path.join(tmp_dir, "payload.pkl"), 'wb') as f:
+        pickle.dump({'payload': payload, 'spans': spans}, f, protocol=5)
+
+    # Directory rename is atomic; if another worker won the race keep theirs
+    try:
+        os.rename(tmp_dir, directory)
+    except OSError:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def attach(directory):
+    payload_path = os.path.join(directory, "payload.pkl")
+    if not os.path.exists(payload_path):
+        return None
+    with open(payload_path, 'rb') as f:
+        index = pickle.load(f)
+
+    views = []
+    if index['spans']:
+        with open(os.path.join(directory, "buffers.bin"), 'rb') as f:
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        whole = memoryview(mapping)
+        views = [whole[offset:offset + size] for offset, size in index['spans']]
+    return pickle.loads(index['payload'], buffers=views)
+
+
+def prune(root, keep):
+    # Mapped files stay valid after unlinking, so old bundles can go at once
+    for name in os.listdir(root):
+        if name != keep and not name.endswith(".lock"):
+            shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+
+
+@contextmanager
+def file_lock(path):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
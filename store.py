@@ -0,0 +1,177 @@
+import os
+import threading
+import time
+
+from aggregates import PopularityCube, TrackFeatures
+from data_loader import CACHE_DIR, CACHE_VERSION, DATA_PATH, cached_state, sync_dataset
+from indexes import ArtistBridge, EntityIndex, SearchIndex
+from queries import open_queries, query_engine
+from shared_data import attach, file_lock, prune, publish
+
+# Seconds between checks of the CSV for new snapshot days (0 disables)
+REFRESH_SECONDS = int(os.environ.get("SPOTIFY_REFRESH_SECONDS", 300))
+
+# Where workers publish/attach the memory-mapped dataset; unset means
+# "<cache dir>/shared", an empty string turns sharing off
+SHARED_DIR = os.environ.get("SPOTIFY_SHARED_DIR")
+
+# Bump whenever ChartData gains or changes a derived structure
+BUNDLE_VERSION = 5
+
+# The popularity cubes and track features only answer in-memory queries; a
+# SQL query backend answers those callbacks from its database instead
+MEMORY_AGGREGATES = query_engine() == 'memory'
+
+# Audio features to analyze
+AUDIO_FEATURES = [
+    'danceability', 'energy', 'acousticness', 'instrumentalness', 'liveness',
+    'valence', 'tempo', 'speechiness', 'loudness', 'duration_ms'
+]
+
+
+# The cleaned chart table plus every index and aggregate derived from it. A
+# new bundle is built off to the side on refresh and swapped in with a single
+# assignment, so callbacks never see a table and an index that disagree.
+class ChartData:
+    def __init__(self, table, version=0, features=AUDIO_FEATURES, aggregates=MEMORY_AGGREGATES):
+        self.table = table
+        self.version = version
+        self.track_cube = self.artist_cube = self.track_features = None
+
+        # Credits split into one (row, artist) pair per credited artist, so
+        # the artist view covers collaborations
+        self.artist_bridge = ArtistBridge(table['artists'])
+        artists, rows = self.artist_bridge.keys(), self.artist_bridge.rows
+        paired = table.facts[['snapshot_date', 'country', 'popularity']].take(rows).reset_index(drop=True)
+
+        # Per-entity row positions, sorted by date, for the map and line chart
+        track_ids = table['track_id']
+        self.track_index = EntityIndex(track_ids, table['snapshot_date'])
+        self.artist_index = EntityIndex(artists, paired['snapshot_date'], rows)
+
+        if aggregates:
+            # Popularity by entity x country x day, reduced per country for the map
+            self.track_cube = PopularityCube(track_ids, table['country'], table['snapshot_date'], table['popularity'])
+            self.artist_cube = PopularityCube(artists, paired['country'], paired['snapshot_date'], paired['popularity'])
+
+            # One row of mean audio features per track, for the top-K bar chart
+            self.track_features = TrackFeatures(table, features)
+
+        # Sorted, searchable artist/song names for the entity dropdown
+        self.artist_search = SearchIndex(self.artist_bridge.names)
+        self.track_search = SearchIndex(track_ids)
+
+    def entity_index(self, view):
+        return self.track_index if view == 'song' else self.artist_index
+
+    def cube(self, view):
+        return self.track_cube if view == 'song' else self.artist_cube
+
+    def search(self, view):
+        return self.track_search if view == 'song' else self.artist_search
+
+
+def _bundle_name(state):
+    # Bundles built with and without the in-memory aggregates never mix
+    return f"{state['hash']}-v{CACHE_VERSION}.{BUNDLE_VERSION}{'' if MEMORY_AGGREGATES else '-sql'}"
+
+
+# Owns the current ChartData. With a shared directory (the default) the
+# first worker to see a CSV state builds the bundle and publishes it as a
+# memory-mapped file; every other gunicorn/uwsgi worker attaches to those
+# pages zero-copy instead of loading its own copy of the dataset.
+class ChartStore:
+    def __init__(self, path=DATA_PATH, cache_dir=CACHE_DIR, shared_dir=SHARED_DIR):
+        self.path = path
+        self.cache_dir = cache_dir
+        if shared_dir is None:
+            shared_dir = os.path.join(cache_dir, "shared")
+        self.shared_dir = shared_dir or None
+        self.data = None
+        self.queries = None
+        self._state = None
+        self._listeners = []
+        self._lock = threading.Lock()
+        self._sync()
+        self._open_queries()
+
+    @property
+    def state_hash(self):
+        # Identifies the CSV contents behind self.data the same way in every
+        # worker, unlike the per-process version counter
+        return self._state['hash']
+
+    def subscribe(self, listener):
+        # Called with the new ChartData after every refresh that added rows
+        self._listeners.append(listener)
+
+    def _open_queries(self):
+        # The map, daily series, bar chart and scatter query through this
+        self.queries = open_queries(self.data, self.cache_dir, self.state_hash, AUDIO_FEATURES)
+
+    def _ingest(self):
+        data = self.data
+        current = None if data is None else data.table
+        table, self._state, new_rows = sync_dataset(self.path, self.cache_dir, current, self._state)
+        if table is not current:
+            self.data = ChartData(table, 0 if data is None else data.version + 1)
+        return new_rows
+
+    def _attach(self):
+        # Map the bundle another worker already published for this CSV state
+        state = cached_state(self.path, self.cache_dir)
+        if state is None or (self._state is not None and state['hash'] == self._state['hash']):
+            return False
+        data = attach(os.path.join(self.shared_dir, _bundle_name(state)))
+        if data is None:
+            return False
+        data.version = 0 if self.data is None else self.data.version + 1
+        self.data, self._state = data, state
+        return True
+
+    def _sync(self):
+        if self.shared_dir is None:
+            return self._ingest()
+
+        with file_lock(os.path.join(self.shared_dir, "publish.lock")):
+            before = self.data
+            if self._attach():
+                return None if before is None else len(self.data.table) - len(before.table)
+            new_rows = self._ingest()
+            name = _bundle_name(self._state)
+            if not os.path.exists(os.path.join(self.shared_dir, name)):
+                publish(self.data, os.path.join(self.shared_dir, name))
+                prune(self.shared_dir, keep=name)
+            return new_rows
+
+    def refresh(self):
+        # Ingest snapshot days added to the CSV since the last load
+        with self._lock:
+            before = self.data
+            new_rows = self._sync()
+            if self.data is before:
+                return 0
+            self._open_queries()
+
+        for listener in self._listeners:
+            listener(self.data)
+        return new_rows
+
+    def watch(self, interval=REFRESH_SECONDS):
+        if interval <= 0:
+            return None
+
+        def poll():
+            while True:
+                time.sleep(interval)
+                try:
+                    new_rows = self.refresh()
+                except Exception as e:
+                    print(f"Error refreshing dataset: {str(e)}")
+                    continue
+                if new_rows:
+                    print(f"Ingested {new_rows} new chart rows (dataset version {self.data.version})")
+
+        thread = threading.Thread(target=poll, name="chart-refresh", daemon=True)
+        thread.start()
+        return thread
@@ -0,0 +1,151 @@
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+from trajectory import TRAJECTORY_COLUMNS
+
+# Columns that change per chart row; everything else a cleaned frame holds
+# (artists, album, release date, the audio profile) describes the track and
+# is stored once per track in the track table
+FACT_COLUMNS = [
+    'country', 'snapshot_date', 'daily_rank', 'daily_movement', 'weekly_movement',
+    'popularity', 'year', 'month',
+] + TRAJECTORY_COLUMNS
+
+
+def concat_column(parts):
+    # pd.concat turns categoricals with different categories into object
+    # columns; union them instead so the appended column stays compact
+    if all(isinstance(part.dtype, pd.CategoricalDtype) for part in parts):
+        return pd.Categorical(union_categoricals(parts, sort_categories=True))
+    return pd.concat(parts, ignore_index=True)
+
+
+def concat_frames(frames):
+    frames = [frame for frame in frames if len(frame)] or frames[:1]
+    if len(frames) == 1:
+        return frames[0]
+    # The joined columns are new, so the frame can adopt them without a copy
+    return pd.DataFrame({col: concat_column([frame[col] for frame in frames]) for col in frames[0].columns},
+                        copy=False)
+
+
+def _first_rows(codes, size):
+    # Position of the first occurrence of each code 0..size-1
+    first = np.full(size, len(codes), dtype='int64')
+    np.minimum.at(first, codes, np.arange(len(codes)))
+    return first
+
+
+# A cleaned chart frame stored as a fact table (one row per chart entry:
+# a track code, country, day, ranks and popularity) and a track table (one
+# row per distinct track description). Track columns are joined onto the
+# chart rows only when a caller asks for them, through the integer codes.
+class ChartTable:
+    def __init__(self, facts, tracks):
+        self.facts = facts
+        self.tracks = tracks
+
+    @property
+    def track(self):
+        # Track table row of every chart row
+        return self.facts['track'].to_numpy()
+
+    @property
+    def columns(self):
+        return pd.Index([col for col in self.facts.columns if col != 'track']
+                        + [col for col in self.tracks.columns if col != 'track_key'])
+
+    def __len__(self):
+        return len(self.facts)
+
+    def __getitem__(self, key):
+        if not isinstance(key, str):
+            return pd.DataFrame({name: self[name] for name in key}, copy=False)
+        if key in self.facts.columns:
+            return self.facts[key]
+        return self.tracks[key].take(self.track).reset_index(drop=True)
+
+    def __setitem__(self, name, values):
+        # Only per-row columns can be added
+        self.facts[name] = values
+
+    def take(self, name, rows):
+        # Values of one column at the given chart row positions
+        if name in self.facts.columns:
+            return self.facts[name].to_numpy()[rows]
+        return self.tracks[name].to_numpy()[self.track[rows]]
+
+    def drop(self, columns):
+        return ChartTable(self.facts.drop(columns=columns), self.tracks)
+
+    def frame(self):
+        # The wide frame, with every track column repeated per chart row
+        return self[list(self.columns)]
+
+    def memory_usage(self):
+        return int(self.facts.memory_usage(deep=True).sum() + self.tracks.memory_usage(deep=True).sum())
+
+
+def split_frame(df):
+    # Rows whose track columns hash alike share one track table row; the
+    # hash covers the whole description, so two songs behind the same label
+    # (album-named exports, re-releases) keep their own audio profile
+    track_columns = [col for col in df.columns if col not in FACT_COLUMNS]
+    keys = pd.util.hash_pandas_object(df[track_columns], index=False).to_numpy()
+    codes, uniques = pd.factorize(keys)
+
+    tracks = df[track_columns].take(_first_rows(codes, len(uniques))).reset_index(drop=True)
+    tracks['track_key'] = uniques
+    facts = df[[col for col in df.columns if col in FACT_COLUMNS]].reset_index(drop=True)
+    facts.insert(0, 'track', codes.astype('int32'))
+    return ChartTable(facts, tracks)
+
+
+def merge_tracks(known, new):
+    # Tracks of `new` missing from `known` are appended after it; returns the
+    # merged track table and the code of every `new` track in it
+    merged = concat_frames([known, new])
+    codes, uniques = pd.factorize(merged['track_key'].to_numpy())
+    merged = merged.take(_first_rows(codes, len(uniques))).reset_index(drop=True)
+    return merged, codes[len(known):].astype('int32')
+
+
+# Assembles one ChartTable from parts added in order. Tracks are merged as
+# each part arrives, and fact columns are only joined in build(), one at a
+# time with their pieces dropped, so the parts are released as it goes.
+class TableBuilder:
+    def __init__(self):
+        self.pieces = {}
+        self.tracks = None
+
+    def add(self, table, copy=False):
+        # copy=True detaches the columns so the part's own frames can be freed
+        codes = table.track
+        if self.tracks is None:
+            self.tracks = table.tracks
+        else:
+            self.tracks, remap = merge_tracks(self.tracks, table.tracks)
+            codes = remap[codes]
+        for col in table.facts.columns:
+            if col == 'track':
+                piece = pd.Series(codes, dtype='int32')
+            else:
+                piece = table.facts[col].copy() if copy else table.facts[col]
+            self.pieces.setdefault(col, []).append(piece)
+
+    def build(self):
+        pieces, self.pieces = self.pieces, {}
+        facts = pd.DataFrame({col: concat_column(pieces.pop(col)) for col in list(pieces)}, copy=False)
+        return ChartTable(facts, self.tracks)
+
+
+def concat_tables(tables):
+    # Tracks already known keep their code; new ones are appended after them
+    tables = [table for table in tables if len(table)] or tables[:1]
+    if len(tables) == 1:
+        return tables[0]
+    builder = TableBuilder()
+    for table in tables:
+        builder.add(table)
+    return builder.build()
@@ -0,0 +1,174 @@
+import numpy as np
+import pandas as pd
+
+from indexes import to_date_ns
+
+# Calendar-day windows of the rolling rank/popularity means
+ROLLING_WINDOWS = [7, 28]
+
+# Previous chart days further back than this don't count for velocity (a
+# re-entry starts fresh); also the history an incremental update re-reads
+LOOKBACK_DAYS = max(ROLLING_WINDOWS)
+
+SERIES_COLUMNS = ['track_id', 'country', 'snapshot_date', 'daily_rank', 'popularity']
+
+TRAJECTORY_COLUMNS = (
+    ['days_on_chart', 'peak_rank', 'rank_velocity']
+    + [f"rank_{days}d" for days in ROLLING_WINDOWS]
+    + [f"popularity_{days}d" for days in ROLLING_WINDOWS]
+)
+
+NS_PER_DAY = 86_400 * 10**9
+
+# Offsets each series' ranks below all earlier ones, so one running minimum
+# over the whole sorted array restarts at every series
+_RANK_SPAN = 1 << 16
+
+
+def _rolling_mean(key, values, days):
+    # Mean over the last `days` calendar days of the same series, whole days
+    # included; key is sorted and grows by one per day, with a gap between series
+    left = np.searchsorted(key, key - (days - 1), side='left')
+    right = np.searchsorted(key, key, side='right')
+    total = np.concatenate([[0.0], np.cumsum(values, dtype='float64')])
+    mean = total[right] - total[left]
+    mean /= right - left
+    return mean.astype('float32')
+
+
+def _metrics(frame, prior_days=None, prior_peak=None):
+    # One chart series per (track, country); the global chart is its own.
+    # Ranks break ties inside a day so results never depend on row order.
+    # Intermediates are narrowed and dropped as soon as they are used, since
+    # this runs over every chart row on a cold load
+    date_ns = to_date_ns(frame['snapshot_date'])
+    # Rows without a snapshot date belong to no series
+    dated = np.flatnonzero(~np.isnat(date_ns.view('datetime64[ns]')))
+    day = (date_ns[dated] // NS_PER_DAY).astype('int32')
+    series = frame['track_id'].cat.codes.to_numpy()[dated].astype('int64')
+    series *= len(frame['country'].cat.categories) + 1
+    series += frame['country'].cat.codes.to_numpy()[dated] + 1
+    rank = frame['daily_rank'].to_numpy()[dated]
+    sort = np.lexsort((rank, day, series))
+    order = dated[sort]
+    series, day, rank = series[sort], day[sort], rank[sort].astype('int32')
+    del dated, sort
+
+    starts = np.ones(len(order), dtype=bool)
+    starts[1:] = series[1:] != series[:-1]
+    del series
+    new_day = starts.copy()
+    new_day[1:] |= day[1:] != day[:-1]
+    group = (np.cumsum(starts) - 1).astype('int32')
+    group_first = np.flatnonzero(starts)[group]
+    del starts
+
+    columns = {}
+    day_count = np.cumsum(new_day, dtype='int32')
+    days_on_chart = day_count - day_count[group_first] + 1
+    del day_count
+    if prior_days is not None:
+        days_on_chart += prior_days[order].astype('int32')
+    columns['days_on_chart'] = days_on_chart
+    del days_on_chart
+
+    offset = group.astype('int64') * _RANK_SPAN
+    peak = np.minimum.accumulate(rank - offset) + offset
+    del offset
+    if prior_peak is not None:
+        np.minimum(peak, prior_peak[order], out=peak)
+    columns['peak_rank'] = peak.astype('int16')
+    del peak
+
+    # Places gained per day against the best rank of the series' previous
+    # chart day, if that day is recent enough. day_first is the first (best
+    # ranked) row of each row's day
+    day_first = np.where(new_day, np.arange(len(order), dtype='int32'), 0)
+    np.maximum.accumulate(day_first, out=day_first)
+    del new_day
+    velocity = np.full(len(order), np.nan, dtype='float32')
+    previous = np.flatnonzero(day_first > group_first)
+    if len(previous):
+        before = day_first[day_first[previous] - 1]
+        gap = day[previous] - day[before]
+        recent = gap <= LOOKBACK_DAYS
+        previous, before, gap = previous[recent], before[recent], gap[recent]
+        velocity[previous] = (rank[before] - rank[previous]) / gap
+    del day_first, group_first, previous
+    columns['rank_velocity'] = velocity
+    del velocity
+
+    if len(order):
+        key = group.astype('int64')
+        key *= int(day.max()) - int(day.min()) + LOOKBACK_DAYS + 1
+        key += day - day.min()
+        del group, day
+        popularity = frame['popularity'].to_numpy()[order]
+        for days in ROLLING_WINDOWS:
+            columns[f"rank_{days}d"] = _rolling_mean(key, rank, days)
+            columns[f"popularity_{days}d"] = _rolling_mean(key, popularity, days)
+    else:
+        for days in ROLLING_WINDOWS:
+            columns[f"rank_{days}d"] = np.empty(0, dtype='float32')
+            columns[f"popularity_{days}d"] = np.empty(0, dtype='float32')
+
+    # Back from series order to the frame's row order
+    result = {}
+    for name in TRAJECTORY_COLUMNS:
+        values = columns.pop(name)
+        full = np.full(len(frame), 0 if values.dtype.kind == 'i' else np.nan, dtype=values.dtype)
+        full[order] = values
+        result[name] = full
+    return pd.DataFrame(result, copy=False)
+
+
+# Adds (in place) the per (track, country) trajectory columns to a ChartTable
+# or cleaned frame:
+# days on chart, peak rank, rank velocity and rolling rank/popularity means.
+# With `history` (an earlier table that already has them and whose days all
+# precede df's) only df's rows are computed, from the last LOOKBACK_DAYS of
+# history plus each series' earlier days on chart and best rank. With
+# `max_rows`, tracks are split into parts of about that many rows, computed
+# one at a time to bound the working memory (a series never spans tracks).
+def add_trajectory(df, history=None, max_rows=None):
+    source = df[SERIES_COLUMNS].reset_index(drop=True)
+    prior_days = prior_peak = None
+
+    if history is not None and len(history):
+        cutoff = df['snapshot_date'].min() - pd.Timedelta(days=LOOKBACK_DAYS)
+        recent = (history['snapshot_date'] >= cutoff).to_numpy()
+        past = history[SERIES_COLUMNS + ['days_on_chart', 'peak_rank']]
+        tail = past.loc[recent, SERIES_COLUMNS].reset_index(drop=True)
+        source = pd.concat([tail, source], ignore_index=True).astype({'track_id': 'category', 'country': 'category'})
+
+        older = past.loc[~recent, ['track_id', 'country', 'days_on_chart', 'peak_rank']]
+        if len(older):
+            seen = older.groupby(['track_id', 'country'], observed=True, dropna=False).agg(
+                days=('days_on_chart', 'max'), peak=('peak_rank', 'min'))
+            where = seen.index.get_indexer(pd.MultiIndex.from_frame(source[['track_id', 'country']].astype(object)))
+            found = where >= 0
+            prior_days = np.where(found, seen['days'].to_numpy('int64')[where], 0)
+            prior_peak = np.where(found, seen['peak'].to_numpy('int64')[where], _RANK_SPAN)
+
+    parts = max(1, -(-len(source) // max_rows)) if max_rows else 1
+    if parts == 1:
+        metrics = _metrics(source, prior_days, prior_peak)
+        columns = {name: metrics[name].to_numpy() for name in TRAJECTORY_COLUMNS}
+    else:
+        part = source['track_id'].cat.codes.to_numpy() % parts
+        columns = {}
+        for p in range(parts):
+            rows = np.flatnonzero(part == p)
+            metrics = _metrics(source.take(rows),
+                               None if prior_days is None else prior_days[rows],
+                               None if prior_peak is None else prior_peak[rows])
+            for name in TRAJECTORY_COLUMNS:
+                if name not in columns:
+                    columns[name] = np.empty(len(source), dtype=metrics[name].dtype)
+                columns[name][rows] = metrics[name].to_numpy()
+            del metrics
+
+    skip = len(source) - len(df)
+    for name in TRAJECTORY_COLUMNS:
+        df[name] = columns.pop(name)[skip:]
+    return df
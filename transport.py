@@ -0,0 +1,58 @@
+import base64
+import os
+
+import numpy as np
+
+try:
+    import flask_compress
+except ImportError:  # Responses then go out uncompressed
+    flask_compress = None
+
+# Send numeric figure arrays as base64 typed buffers instead of JSON number
+# lists; plotly.js (>= 2.28) decodes {'dtype', 'bdata', 'shape'} natively.
+# Off by default: chart features have few decimals, so once gzip is on the
+# JSON text compresses better than base64 floats (see benchmark wire_bytes)
+BINARY_FIGURES = os.environ.get("SPOTIFY_BINARY_FIGURES", "0") == "1"
+
+# gzip callback responses and assets when flask-compress is installed
+COMPRESS_RESPONSES = flask_compress is not None and os.environ.get("SPOTIFY_COMPRESS", "1") != "0"
+
+# Shorter arrays stay JSON lists, the wrapper would cost more than it saves
+MIN_BINARY_LENGTH = 32
+
+
+def _typed_array(values):
+    kind, size = values.dtype.kind, values.dtype.itemsize
+    if kind == 'f':
+        # Single precision is far finer than a pixel on any axis
+        code = 'f4'
+    elif size <= 4:
+        code = f"{kind}{size}"
+    elif values.size == 0 or (values.min() >= np.iinfo('int32').min and values.max() <= np.iinfo('int32').max):
+        # plotly.js has no 64-bit integer arrays
+        code = 'i4'
+    else:
+        code = 'f8'
+    array = np.ascontiguousarray(values, dtype=f"<{code}")
+    spec = {'dtype': code, 'bdata': base64.b64encode(array).decode('ascii')}
+    if array.ndim > 1:
+        spec['shape'] = ",".join(map(str, array.shape))
+    return spec
+
+
+def encode_arrays(node):
+    if isinstance(node, dict):
+        return {key: encode_arrays(value) for key, value in node.items()}
+    if isinstance(node, (list, tuple)):
+        return [encode_arrays(value) for value in node]
+    if isinstance(node, np.ndarray) and node.dtype.kind in 'iuf' and node.size >= MIN_BINARY_LENGTH:
+        return _typed_array(node)
+    return node
+
+
+def compact_figure(fig):
+    # Figure as a plain dict with its numeric trace arrays binary-encoded
+    if not BINARY_FIGURES:
+        return fig
+    figure = fig if isinstance(fig, dict) else fig.to_plotly_json()
+    return {'data': encode_arrays(figure['data']), 'layout': figure['layout']}
@@ -1,36 +1,76 @@
 import dash
-from dash import dcc, html, Input, Output
-import pandas as pd
+from dash import dcc, html, ctx, no_update, ClientsideFunction, Input, Output, State
 import plotly.express as px
 import dash_bootstrap_components as dbc
 import os
+from flask import Flask, jsonify
 
-# Load dataset
-df = pd.read_csv("universal_top_spotify_songs.csv")
+from countries import iso3_codes
+from figure_cache import figure_cache
+from figures import map_figure, scatter_plot, trajectory_figure
+from jobs import heavy_callback, make_manager, report_progress
+from metrics import callback_metrics, lap
+from selection import MAX_COMPARE, entity_list, selection_cache
+from store import AUDIO_FEATURES, ChartStore
+from transport import COMPRESS_RESPONSES, compact_figure
 
-# Clean & prep columns
-df.columns = df.columns.str.strip().str.lower().str.replace(" ", "_")
-df['snapshot_date'] = pd.to_datetime(df['snapshot_date'], errors='coerce')
-df['year'] = df['snapshot_date'].dt.year
-df['month'] = df['snapshot_date'].dt.month
+# Load dataset (cleaned, served from the columnar cache after the first run)
+# together with every index and aggregate the callbacks read from
+store = ChartStore()
+
+# Boot-time chart table for the layout defaults; callbacks always read store.data
+df = store.data.table
 
 # Audio features to analyze
-audio_features = [
-    'danceability', 'energy', 'acousticness', 'instrumentalness', 'liveness',
-    'valence', 'tempo', 'speechiness', 'loudness', 'duration_ms'
-]
+audio_features = AUDIO_FEATURES
+
+# Most options the entity dropdown receives per keystroke
+DROPDOWN_LIMIT = 50
+
+# Trajectory dropdown value of the global chart (rows without a country)
+GLOBAL_CHART = 'global'
+
+
+def country_options(data):
+    countries = data.table['country'].cat.categories
+    names = iso3_codes(countries)[1]
+    options = sorted(({'label': name, 'value': code} for code, name in zip(countries, names)),
+                     key=lambda option: option['label'])
+    return [{'label': 'Global', 'value': GLOBAL_CHART}] + options
 
-# Get top unique artists/songs
-df['artists'] = df['artists'].astype(str)
-df['track_id'] = df['artists'] + " | " + df['name']
-top_artists = df['artists'].dropna().unique()
-top_tracks = df['track_id'].dropna().unique()
+# Pick up new snapshot days without a restart; cached figures and
+# selections are dropped whenever the dataset version moves
+store.subscribe(lambda data: figure_cache.bump_version())
+store.subscribe(lambda data: selection_cache.clear())
+store.watch()
 
-px.set_mapbox_access_token(open(".mapbox_token").read())
+# Bar chart and scatter run as background jobs when diskcache is installed;
+# finished figures are cached on disk per dataset version
+background_manager = make_manager(cache_by=[lambda: store.state_hash])
+
+# A job runs in a throwaway forked process, so its figures are cached by the
+# job manager and its metrics travel back through the job cache; the
+# in-process figure cache only serves callbacks that run inline
+if background_manager is None:
+    heavy_memoize = figure_cache.memoize
+else:
+    heavy_memoize = lambda func: func
+    callback_metrics.share(background_manager.metrics_spool())
+
+# Token is only needed for mapbox tiles; benchmark/CI checkouts run without it
+if os.path.exists(".mapbox_token"):
+    px.set_mapbox_access_token(open(".mapbox_token").read())
+
+# Metrics hooks go on the server before Dash adds compression, so Flask
+# runs them after it and /metrics reports the bytes actually sent
+server = Flask(__name__)
+callback_metrics.init_app(server)
 
 # Dash app setup with external CSS
 app = dash.Dash(
     __name__, 
+    server=server,
+    compress=COMPRESS_RESPONSES,
     external_stylesheets=[
         dbc.themes.BOOTSTRAP,
         "https://cdnjs.cloudflare.com/ajax/libs/font-awesome/5.15.4/css/all.min.css"
@@ -45,6 +85,8 @@ app.css.append_css({
 
 # App layout with Spotify-style design
 app.layout = html.Div([
+    dcc.Location(id='url'),
+
     # DLSU Logo Overlay
     html.Div(
         html.Img(
@@ -273,6 +315,9 @@ app.layout = html.Div([
                                                 html.Label("Select Song/Artist:", className="control-label"),
                                                 dcc.Dropdown(
                                                     id='entity-dropdown',
+                                                    # Pick several to compare them on the map and line chart
+                                                    multi=True,
+                                                    placeholder=f"Select up to {MAX_COMPARE} to compare",
                                                         style={
                                                             'backgroundColor': '#000000',
                                                             'color': '#FFFFFF'
@@ -353,12 +398,44 @@ app.layout = html.Div([
                                         [
                                             html.H4("Popularity Trend Over Time"),
                                             dcc.Graph(id='line-chart', className="visualization-container"),
+                                            # Whole daily series of the selected entity; the date
+                                            # window is applied in the browser (assets/clientside.js)
+                                            dcc.Store(id='daily-series'),
                                             html.P(
                                                 "This line graph tracks how audio features like danceability and energy have changed over time for the selected songs.",
                                                 className="chart-description"
                                             )
                                         ],
                                         className="content-section"
+                                    ),
+
+                                    # Chart Trajectory
+                                    html.Div(
+                                        [
+                                            html.H4("Chart Trajectory"),
+                                            html.Div(
+                                                [
+                                                    html.Label("Chart:", className="control-label"),
+                                                    dcc.Dropdown(
+                                                        id='trajectory-country',
+                                                        options=country_options(store.data),
+                                                        value=GLOBAL_CHART,
+                                                        clearable=False,
+                                                        style={
+                                                                'backgroundColor': '#000000',
+                                                                'color': '#FFFFFF'
+                                                            }
+                                                    )
+                                                ],
+                                                className="control-group mb-3"
+                                            ),
+                                            dcc.Graph(id='trajectory-chart', className="visualization-container"),
+                                            html.P(
+                                                "This chart follows the daily rank of the selected songs on one chart, with the dotted line showing the 7-day average rank.",
+                                                className="chart-description"
+                                            )
+                                        ],
+                                        className="content-section"
                                     )
                                 ],
                                 #width=12, md=8
@@ -391,6 +468,7 @@ app.layout = html.Div([
                                                 className="control-group mb-3"
                                             ),
                                     dcc.Graph(id='bar-chart', className="visualization-container"),
+                                    html.Div(id='bar-progress', className="chart-description", style={'display': 'none'}),
                                     html.P(
                                         "This bar chart shows the top songs based on the selected audio feature.",
                                         className="chart-description"
@@ -433,6 +511,7 @@ app.layout = html.Div([
                                         className="mb-3"
                                     ),
                                     dcc.Graph(id='scatter-plot', className="visualization-container"),
+                                    html.Div(id='scatter-progress', className="chart-description", style={'display': 'none'}),
                                     html.P(
                                         "The scatter plot reveals relationships between different audio features and popularity.",
                                         className="chart-description"
@@ -519,64 +598,107 @@ app.layout = html.Div([
     )
 ])
 
+# Give each browser a session cookie so its entity selections get their own
+# cache entries
+selection_cache.init_app(app.server)
+
 # Callback functions (same as before)
+
+# Stretch the date pickers to the snapshot days ingested since boot
+@app.callback(
+    Output('start-date', 'max_date_allowed'),
+    Output('end-date', 'max_date_allowed'),
+    Output('end-date', 'date'),
+    Input('url', 'pathname')
+)
+@callback_metrics.instrument
+def sync_date_range(pathname):
+    last_date = store.data.table['snapshot_date'].max().date()
+    return last_date, last_date, last_date
+
 @app.callback(
     Output('entity-dropdown', 'options'),
     Output('entity-dropdown', 'value'),
-    Input('view-radio', 'value')
+    Input('view-radio', 'value'),
+    Input('entity-dropdown', 'search_value'),
+    Input('entity-dropdown', 'value')
 )
-def update_dropdown(view_type):
-    if view_type == 'song':
-        options = [{'label': name, 'value': name} for name in sorted(top_tracks)]
-        return options, options[0]['value']
-    else:
-        options = [{'label': name, 'value': name} for name in sorted(top_artists)]
-        return options, options[0]['value']
+@callback_metrics.instrument
+def update_dropdown(view_type, search_value, current):
+    search = store.data.search(view_type)
+
+    # Switching view (or the first load) resets the selection to the first
+    # entity; a cleared dropdown stays empty while the user types
+    if ctx.triggered_id != 'entity-dropdown':
+        names = search.search(None, DROPDOWN_LIMIT)
+        lap('filter')
+        options = [{'label': name, 'value': name} for name in names]
+        lap('figure')
+        return options, names[:1]
+
+    # Typing only swaps the matching options and keeps the selection visible.
+    # Once MAX_COMPARE entities are picked the other options are disabled,
+    # and a longer selection is trimmed so the dropdown shows what is plotted
+    selected = entity_list(current)
+    names = search.search(search_value, DROPDOWN_LIMIT)
+    names = selected + [name for name in names if name not in selected]
+    lap('filter')
+    full = len(selected) >= MAX_COMPARE
+    options = [{'label': name, 'value': name, 'disabled': full and name not in selected} for name in names]
+    lap('figure')
+    trimmed = isinstance(current, list) and len(current) > len(selected)
+    return options, selected if trimmed else no_update
 
 @app.callback(
     Output('choropleth-map', 'figure'),
-    Output('line-chart', 'figure'),
     Input('view-radio', 'value'),
     Input('entity-dropdown', 'value'),
     Input('start-date', 'date'),
     Input('end-date', 'date')
 )
-def update_visuals(view, entity, start_date, end_date):
-    # Convert string dates to datetime
-    start_date = pd.to_datetime(start_date)
-    end_date = pd.to_datetime(end_date)
-    
-    # Filter data by date range
-    dff = df[(df['snapshot_date'] >= start_date) & (df['snapshot_date'] <= end_date)]
+@callback_metrics.instrument
+def update_map(view, entities, start_date, end_date):
+    # Shared selection stage: in memory each entity's rows are sliced once
+    # per session and only re-windowed when just the date pickers move; the
+    # SQL backend resolves the entities to their tracks
+    selection = store.queries.select(view, entities, start_date, end_date)
+    lap('filter')
 
-    if view == 'song':
-        dff = dff[dff['track_id'] == entity]
-    else:
-        dff = dff[dff['artists'] == entity]
-
-    map_fig = px.choropleth(
-        dff,
-        locations='country',
-        locationmode='country names',
-        color='popularity',
-        color_continuous_scale='cividis',
-        hover_name='country',
-        title='Popularity by Country'
-    )
-    map_fig.update_layout(
-        paper_bgcolor='#282828', 
-        plot_bgcolor='#282828', 
-        font_color='#FFFFFF',
-        margin=dict(l=20, r=20, t=40, b=20)
-    )
+    # One value per entity and country over the selected window, from the
+    # cube or the database, with the global chart kept as its own series
+    country_popularity = selection.by_country()
+    global_chart = selection.global_chart()
+    lap('aggregate')
+
+    # Prebuilt geo layout; only the ISO-3 choropleth traces are new
+    map_fig = map_figure(selection.entities, country_popularity, global_chart)
+    lap('figure')
+
+    map_fig = compact_figure(map_fig)
+    lap('serialize')
+
+    return map_fig
+
+# The daily series only changes with the entity, so it is shipped once and
+# date-picker changes never reach the server
+@app.callback(
+    Output('daily-series', 'data'),
+    Input('view-radio', 'value'),
+    Input('entity-dropdown', 'value')
+)
+@callback_metrics.instrument
+def update_daily_series(view, entities):
+    selection = store.queries.select(view, entities, None, None)
+    lap('filter')
 
-    # NEW: Line chart showing daily popularity
-    daily_popularity = dff.groupby('snapshot_date')['popularity'].mean().reset_index()
+    # NEW: Line chart showing daily popularity, every selected entity averaged in one pass
+    daily_popularity = selection.daily_mean('popularity')
+    lap('aggregate')
     line_fig = px.line(
-        daily_popularity, 
+        daily_popularity.iloc[:0], 
         x='snapshot_date', 
         y='popularity',
-        title=f'Daily Popularity Trend for {entity}'
+        title=f"Daily Popularity Trend for {', '.join(selection.entities)}"
     )
     line_fig.update_layout(
         paper_bgcolor='#282828', 
@@ -586,17 +708,77 @@ def update_visuals(view, entity, start_date, end_date):
         xaxis_title='Date',
         yaxis_title='Popularity Score'
     )
-    line_fig.update_traces(line_color='#1DB954')  # Spotify green line
+    if len(selection.entities) == 1:
+        line_fig.update_traces(line_color='#1DB954')  # Spotify green line
+    else:
+        line_fig.update_traces(line_color=None)  # Compared entities take the colourway
+
+    # Plain lists the browser can window without decoding the figure; the
+    # empty trace is the style template for one trace per entity
+    daily_popularity['date'] = daily_popularity['snapshot_date'].dt.strftime('%Y-%m-%d')
+    series = {
+        'figure': line_fig.to_plotly_json(),
+        'series': [
+            {
+                'entity': entity,
+                'dates': rows['date'].tolist(),
+                'popularity': rows['popularity'].round(2).tolist(),
+            }
+            for entity, rows in daily_popularity.groupby('entity', sort=False)
+        ],
+    }
+    lap('figure')
 
-    return map_fig, line_fig
+    return series
 
+app.clientside_callback(
+    ClientsideFunction(namespace='spotify', function_name='dailyPopularity'),
+    Output('line-chart', 'figure'),
+    Input('daily-series', 'data'),
+    Input('start-date', 'date'),
+    Input('end-date', 'date')
+)
+
+# Trajectory metrics are stored per row by the loader, so this only
+# gathers the selected entity's rows on one chart
 @app.callback(
+    Output('trajectory-chart', 'figure'),
+    Input('view-radio', 'value'),
+    Input('entity-dropdown', 'value'),
+    Input('trajectory-country', 'value'),
+    Input('start-date', 'date'),
+    Input('end-date', 'date')
+)
+@callback_metrics.instrument
+def update_trajectory(view, entities, country, start_date, end_date):
+    selection = selection_cache.select(store.data, view, entities, start_date, end_date)
+    lap('filter')
+
+    # Artists follow their best ranked track of each day
+    chart_days = selection.chart_days(None if country in (None, GLOBAL_CHART) else country)
+    lap('aggregate')
+
+    options = {option['value']: option['label'] for option in country_options(store.data)}
+    trajectory_fig = trajectory_figure(selection.entities, chart_days, options.get(country, 'Global'))
+    lap('figure')
+
+    trajectory_fig = compact_figure(trajectory_fig)
+    lap('serialize')
+
+    return trajectory_fig
+
+@heavy_callback(
+    app, background_manager,
     Output('bar-chart', 'figure'),
-    Input('bar-attribute', 'value')
+    Input('bar-attribute', 'value'),
+    progress=Output('bar-progress', 'children'),
+    running=[(Output('bar-progress', 'style'), {'display': 'block'}, {'display': 'none'})]
 )
+@callback_metrics.instrument
+@heavy_memoize
 def update_bar_chart(attribute):
     # Handle None or invalid attribute
-    if attribute is None or attribute not in df.columns:
+    if attribute is None or attribute not in store.data.table.columns:
         # Return empty figure with same styling using px
         fig = px.bar(title="Select an audio feature to display data")
         fig.update_layout(
@@ -615,7 +797,9 @@ def update_bar_chart(attribute):
     
     try:
         # Get top 10 songs by selected attribute
-        bar_data = df.groupby('track_id')[attribute].mean().sort_values(ascending=False).head(10).reset_index()
+        report_progress("Ranking tracks…")
+        bar_data = store.queries.top_tracks(attribute, 10)
+        lap('aggregate')
         
         # Create horizontal bar chart
         fig = px.bar(
@@ -645,6 +829,7 @@ def update_bar_chart(attribute):
             dtick=0.1,
             range=[0, 1] if attribute in ['danceability', 'energy', 'valence'] else None
         )
+        lap('figure')
         
         return fig
     
@@ -659,22 +844,28 @@ def update_bar_chart(attribute):
         )
         return fig
 
-@app.callback(
+@heavy_callback(
+    app, background_manager,
     Output('scatter-plot', 'figure'),
     Input('x-attribute', 'value'),
-    Input('y-attribute', 'value')
+    Input('y-attribute', 'value'),
+    progress=Output('scatter-progress', 'children'),
+    running=[(Output('scatter-progress', 'style'), {'display': 'block'}, {'display': 'none'})]
 )
+@callback_metrics.instrument
+@heavy_memoize
 def update_scatter(x_attr, y_attr):
-    fig = px.scatter(df, x=x_attr, y=y_attr, color='popularity', color_continuous_scale='cividis',
-                     hover_name='artists', 
-                     title=f"{x_attr.capitalize()} vs {y_attr.capitalize()}")
-    fig.update_layout(
-        paper_bgcolor='#282828', 
-        plot_bgcolor='#282828', 
-        font_color='#FFFFFF',
-        margin=dict(l=20, r=20, t=40, b=20)
-    )
+    # Switches to per-track points or a density grid above the point budget;
+    # the SQL backend aggregates those two in the database
+    fig = compact_figure(scatter_plot(*store.queries.scatter_data(x_attr, y_attr), x_attr, y_attr))
+    lap('serialize')
     return fig
 
+# Hit/miss counters of whichever cache holds the finished figures
+@app.server.route('/figure-cache')
+def figure_cache_stats():
+    stats = figure_cache.stats() if background_manager is None else background_manager.stats()
+    return jsonify({**stats, 'selections': selection_cache.stats()})
+
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file